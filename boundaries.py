@@ -0,0 +1,15 @@
+import argparse
+
+from reporter.geography import GEOGRAPHIES, compile_geography
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile the ward and zip boundaries for fast loading"
+    )
+    parser.add_argument(
+        "path", nargs="?", help="directory to write to, BOUNDARY_DIR by default"
+    )
+    args = parser.parse_args()
+    for geog in GEOGRAPHIES:
+        compile_geography(geog, args.path)
+        print("Compiled {} boundaries".format(geog))
@@ -1,9 +1,11 @@
+import logging
 import os
 
-from flask import Flask
+from flask import Flask, g
 
 from .auth import auth, login_manager
 from .database import db_session
+from .geography import dedup_stats, log_dedup_stats, warm_geographies
 from .views import views
 
 
@@ -19,12 +21,35 @@ def create_app():
 # Exposing so can be picked up by Zappa
 app = create_app()
 
+# Lambda leaves the root logger at WARNING, which would drop this package's INFO
+# messages, like the dedup stats logged for each request
+logger = logging.getLogger(__name__)
+if logger.level == logging.NOTSET:
+    logger.setLevel(logging.INFO)
+
+# Build the ward and zip indexes while the Lambda container is starting up
+if os.getenv("WARM_GEOGRAPHIES"):
+    warm_geographies()
+
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
 
 
+# The dedup hit rate of the points a request tested against boundaries, counted
+# by the whole process, is logged once the request, including any stream, ends
+@app.before_request
+def start_dedup_stats():
+    g.dedup_stats = dedup_stats()
+
+
+@app.teardown_request
+def end_dedup_stats(exception=None):
+    if "dedup_stats" in g:
+        log_dedup_stats(g.dedup_stats)
+
+
 if __name__ == "__main__":
     import sys
 
@@ -0,0 +1,144 @@
+import logging
+import os
+
+import numpy as np
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    and_,
+    or_,
+)
+from sqlalchemy.dialects.postgresql import insert
+
+from .database import db_session as session
+from .database import engine
+from .geography import GEOGRAPHIES, get_geography
+from .models import Addresses
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 1000
+
+# The region of every geography each address falls in, named like the
+# geography. Rows only apply while the address still has the same lat and lon.
+address_regions_table = Table(
+    "reporter_address_regions",
+    MetaData(),
+    Column("address_id", Integer, primary_key=True),
+    Column("lat", Float),
+    Column("lon", Float),
+    Column("updated_at", DateTime),
+    *[Column(geog, String) for geog in GEOGRAPHIES],
+)
+
+
+_available = None
+
+
+def address_regions_enabled():
+    return bool(os.getenv("ADDRESS_REGIONS"))
+
+
+def address_regions_available():
+    """Whether stored regions are enabled and the backfill has created their table
+
+    The table is looked for once per process.
+    """
+    global _available
+    if not address_regions_enabled():
+        return False
+    if _available is None:
+        _available = engine.has_table(address_regions_table.name)
+        if not _available:
+            logger.warning("Stored address regions missing, run the backfill")
+    return _available
+
+
+def backfill_address_regions(full=False):
+    """Store the regions of new and changed addresses, returning how many
+
+    An address is reassigned when it has no row yet, its updated_at is newer
+    than the row's, or its coordinates differ. full reassigns every address,
+    which is needed after the boundary files change.
+    """
+    table = address_regions_table
+    table.create(engine, checkfirst=True)
+    query = session.query(
+        Addresses.id, Addresses.lat, Addresses.lon, Addresses.updated_at
+    ).order_by(Addresses.id)
+    if not full:
+        query = query.outerjoin(table, table.c.address_id == Addresses.id).filter(
+            or_(
+                table.c.address_id.is_(None),
+                Addresses.updated_at > table.c.updated_at,
+                Addresses.lat.is_distinct_from(table.c.lat),
+                Addresses.lon.is_distinct_from(table.c.lon),
+            )
+        )
+    addresses = query.all()
+
+    geographies = [get_geography(geog) for geog in GEOGRAPHIES]
+    for start in range(0, len(addresses), BACKFILL_BATCH_SIZE):
+        batch = addresses[start : start + BACKFILL_BATCH_SIZE]
+        rows = [
+            {"address_id": a.id, "lat": a.lat, "lon": a.lon, "updated_at": a.updated_at}
+            for a in batch
+        ]
+        for geography in geographies:
+            regions = geography.assign([a.lon for a in batch], [a.lat for a in batch])
+            for row, idx in zip(rows, regions.tolist()):
+                row[geography.name] = str(geography.regions[idx]) if idx >= 0 else None
+        statement = insert(table)
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[table.c.address_id],
+                set_={
+                    col.name: statement.excluded[col.name]
+                    for col in table.columns
+                    if not col.primary_key
+                },
+            ),
+            rows,
+        )
+    session.commit()
+    logger.info("Assigned regions to %d addresses", len(addresses))
+    return len(addresses)
+
+
+def stored_region_join(address_id, lat, lon):
+    """Return the condition joining stored regions to an address and its position"""
+    table = address_regions_table
+    return and_(
+        table.c.address_id == address_id, table.c.lat == lat, table.c.lon == lon
+    )
+
+
+def stored_region_columns(geography):
+    """Return the stored region column for a geography and whether a row matched"""
+    table = address_regions_table
+    return [
+        table.c[geography.name].label("stored_region"),
+        table.c.address_id.isnot(None).label("region_stored"),
+    ]
+
+
+def resolve_regions(geography, lons, lats, stored, known):
+    """Return region indexes from stored regions, assigning the unknown ones
+
+    stored holds the stored region for each point and known whether there was a
+    stored row at all, as selected by stored_region_columns.
+    """
+    index = {str(region): idx for idx, region in enumerate(geography.regions)}
+    regions = np.array([index.get(region, -1) for region in stored], dtype=np.intp)
+    missing = np.flatnonzero(~np.asarray(known, dtype=bool))
+    if len(missing):
+        regions[missing] = geography.assign(
+            np.asarray(lons, dtype=float)[missing],
+            np.asarray(lats, dtype=float)[missing],
+        )
+    return regions
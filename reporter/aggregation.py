@@ -0,0 +1,206 @@
+from functools import partial
+from itertools import chain
+
+import numpy as np
+
+from .address_regions import (
+    address_regions_available,
+    address_regions_table,
+    resolve_regions,
+    stored_region_columns,
+    stored_region_join,
+)
+from .cache import cached, split_param
+from .categories import get_category_index
+from .database import db_session as session
+from .geography import get_geography
+from .postgis import region_point_counts
+from .rollup import rollup_counts
+from .snapshot import get_snapshot
+from .utils import point_counts, run_concurrently, union_points
+
+
+class AggregationResult:
+    """Calls and issues counted per region of a geography for one set of filters
+
+    totals and category_counts are indexed like geography.regions, the latter
+    holding a {category: count} dict per region. unassigned is the number of
+    calls and issues outside every region, including those without coordinates.
+    """
+
+    def __init__(self, geography, totals, category_counts, unassigned):
+        self.geography = geography
+        self.totals = totals
+        self.category_counts = category_counts
+        self.unassigned = unassigned
+
+    @classmethod
+    def from_dict(cls, geography, data):
+        return cls(
+            geography, data["totals"], data["category_counts"], data["unassigned"]
+        )
+
+    def to_dict(self):
+        return {
+            "totals": self.totals,
+            "category_counts": self.category_counts,
+            "unassigned": self.unassigned,
+        }
+
+    def feature_collection(self):
+        """Return the geography's GeoJSON with ci_count set on regions with any"""
+        chi_areas = self.geography.feature_collection()
+        for feat, count in zip(chi_areas["features"], self.totals):
+            if count:
+                feat["properties"]["ci_count"] = count
+        return chi_areas
+
+    def csv_rows(self):
+        """Return a [region, count] row for every region"""
+        return [list(row) for row in zip(self.geography.regions, self.totals)]
+
+    def region_categories(self):
+        """Return a {category: count} dict keyed by region"""
+        return dict(zip(self.geography.regions, self.category_counts))
+
+
+def count_records(geography, tables):
+    """Count the records in point_counts subqueries into AggregationResult fields
+
+    Counting in-process fetches the calls and the issues at the same time, each
+    on its own connection.
+    """
+    counts = region_point_counts(geography, union_points(tables))
+    if counts is not None:
+        return counts
+
+    stored = address_regions_available()
+    rows = list(
+        chain.from_iterable(
+            run_concurrently(
+                *[partial(_point_rows, geography, table, stored) for table in tables]
+            )
+        )
+    )
+    if stored:
+        regions = resolve_regions(
+            geography,
+            [r.lon for r in rows],
+            [r.lat for r in rows],
+            [r.stored_region for r in rows],
+            [r.region_stored for r in rows],
+        )
+    else:
+        regions = geography.assign([r.lon for r in rows], [r.lat for r in rows])
+    counts = np.array([r.count for r in rows], dtype=np.int64)
+    total = np.array([r.total for r in rows], dtype=bool)
+    category_ids = np.array(
+        [-1 if r.category_id is None else r.category_id for r in rows], dtype=np.int64
+    )
+    assigned = regions >= 0
+    counted = total & assigned
+    totals = np.bincount(
+        regions[counted], weights=counts[counted], minlength=len(geography)
+    )
+
+    # Categories are counted into a regions x categories matrix by column and
+    # only named once the counts are known
+    index = get_category_index(category_ids[category_ids >= 0])
+    category_columns = index.columns(category_ids)
+    counted = ~total & assigned & (category_columns >= 0)
+    matrix = np.zeros((len(geography), len(index)), dtype=np.int64)
+    np.add.at(matrix, (regions[counted], category_columns[counted]), counts[counted])
+    return {
+        "totals": totals.astype(np.int64).tolist(),
+        "category_counts": index.region_dicts(matrix),
+        "unassigned": int(counts[total].sum() - counts[total & assigned].sum()),
+    }
+
+
+def add_counts(counts, other):
+    """Return the sum of AggregationResult fields counted over two date ranges"""
+    category_counts = []
+    for categories, other_categories in zip(
+        counts["category_counts"], other["category_counts"]
+    ):
+        categories = dict(categories)
+        for category, count in other_categories.items():
+            categories[category] = categories.get(category, 0) + count
+        category_counts.append(categories)
+    return {
+        "totals": [a + b for a, b in zip(counts["totals"], other["totals"])],
+        "category_counts": category_counts,
+        "unassigned": counts["unassigned"] + other["unassigned"],
+    }
+
+
+def _point_rows(geography, points, stored):
+    columns = [
+        points.c.total,
+        points.c.category_id,
+        points.c.count,
+        points.c.lon,
+        points.c.lat,
+    ]
+    if not stored:
+        return session.query(*columns).all()
+    join = stored_region_join(points.c.address_id, points.c.lat, points.c.lon)
+    return (
+        session.query(*columns, *stored_region_columns(geography))
+        .outerjoin(address_regions_table, join)
+        .all()
+    )
+
+
+def aggregate(start_date, end_date, categories, zip_codes, geog):
+    """Return the AggregationResult for a set of filters, computing it at most once
+
+    Results are shared through the aggregation cache, so the geo endpoints and
+    the ward breakdown reuse each other's work for the same filters.
+    """
+    geography = get_geography(geog)
+
+    def compute():
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            counts = snapshot.counts(
+                geography,
+                start_date,
+                end_date,
+                split_param(categories),
+                split_param(zip_codes),
+            )
+            if counts is not None:
+                return counts
+        if not zip_codes:
+            rollup = rollup_counts(geography, start_date, end_date, categories)
+            if rollup is not None:
+                counts, live_from = rollup
+                if live_from is None:
+                    return counts
+                tables = point_counts(live_from, end_date, categories, zip_codes)
+                return add_counts(counts, count_records(geography, tables))
+        tables = point_counts(start_date, end_date, categories, zip_codes)
+        return count_records(geography, tables)
+
+    data = cached(
+        "aggregation",
+        start_date,
+        end_date,
+        compute,
+        categories=split_param(categories),
+        zip_codes=split_param(zip_codes),
+        geog=geography.name,
+    )
+    return AggregationResult.from_dict(geography, data)
+
+
+def handle_geog_filter(request, start_date, end_date):
+    """Return the AggregationResult for the filters in a request's arguments"""
+    return aggregate(
+        start_date,
+        end_date,
+        request.args.get("categories"),
+        request.args.get("zip_codes"),
+        request.args.get("geog", "wards"),
+    )
@@ -0,0 +1,43 @@
+# Compares the cold start of the ward and zip geographies built from GeoJSON
+# with loading them from the files compiled by boundaries.py.
+#
+#   python boundaries.py && python -m reporter.bench.bench_boundaries
+#
+# Each run is a fresh interpreter, like a Lambda cold start. It reports the time
+# warm_geographies takes and how much the peak resident memory grew, after
+# importing the package.
+
+import os
+import subprocess
+import sys
+
+ITER = int(os.getenv("TEST_ITER", 5))
+
+CHILD = """
+import resource, time
+from reporter.geography import warm_geographies
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+warm_geographies()
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+"""
+
+
+def cold_start(boundary_dir):
+    env = dict(os.environ, BOUNDARY_DIR=boundary_dir, WARM_GEOGRAPHIES="")
+    runs = []
+    for _ in range(ITER):
+        out = subprocess.check_output([sys.executable, "-c", CHILD], env=env)
+        elapsed, rss = out.split()
+        runs.append((float(elapsed), int(rss)))
+    return min(runs)
+
+
+if __name__ == "__main__":
+    from reporter.geography import boundary_dir
+
+    print("source,warm_ms,rss_kb")
+    for name, path in (("geojson", "/nonexistent"), ("compiled", boundary_dir())):
+        elapsed, rss = cold_start(path)
+        print("%s,%f,%d" % (name, elapsed * 1000, rss))
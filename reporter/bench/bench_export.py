@@ -0,0 +1,122 @@
+# Compares the detail export's rows selected column by column in SQL with the
+# ORM entities and RecordRow objects they replaced, for calls and for issues.
+# Both are written out through CsvExport.iter_rows, and must give the same rows
+# apart from the order of the joined category names, which neither sets.
+#
+#   python -m reporter.bench.bench_export
+#
+# Needs the DB_* settings for a database with calls and issues in it.
+
+import os
+import time
+from collections import defaultdict
+from datetime import date
+
+from sqlalchemy.orm import aliased, contains_eager
+from sqlalchemy.orm.attributes import set_committed_value
+
+from reporter.database import db_session as session
+from reporter.export import ADDRESS_COLS, CSV_COLS, USER_PREFIXES, CsvExport
+from reporter.models import Calls, Categories, Issues, User
+from reporter.utils import detail_query, iter_batches
+
+ITER = int(os.getenv("TEST_ITER", 5))
+
+START_DATE = date(2000, 1, 1)
+
+
+class RecordRow:
+    """RecordRow as it was before exports selected their columns in SQL"""
+
+    def __init__(self, row, cols=CSV_COLS):
+        self.cols = cols
+        for col in self.cols:
+            col_prefix = col.split("_")[0]
+            if col == "call_issue":
+                attr = "issue" if getattr(row, "title", None) else "call"
+            elif col_prefix in USER_PREFIXES:
+                attr_name = col[len(col_prefix) + 1 :]
+                user_obj = getattr(row, col_prefix, None)
+                if user_obj:
+                    attr = getattr(user_obj, attr_name, None)
+                else:
+                    attr = None
+            elif col == "categories":
+                categories = getattr(row, "categories", [])
+                attr = ", ".join([getattr(c, "name", "") for c in categories])
+            elif col in ADDRESS_COLS:
+                if hasattr(row, "address"):
+                    attr = getattr(row.address, col, None)
+                else:
+                    attr = None
+            else:
+                attr = getattr(row, col, None)
+            setattr(self, col, attr)
+
+    def as_list(self):
+        return [getattr(self, c, "") for c in self.cols]
+
+
+def load_categories(cls, records):
+    """Populate the categories of a batch of calls or issues with one query"""
+    categories = defaultdict(list)
+    if records:
+        category_query = (
+            session.query(cls.id, Categories)
+            .join(cls.categories)
+            .filter(cls.id.in_([r.id for r in records]))
+        )
+        for record_id, category in category_query:
+            categories[record_id].append(category)
+    for record in records:
+        set_committed_value(record, "categories", categories[record.id])
+
+
+def orm_rows(cls):
+    users = {prefix: aliased(User) for prefix in USER_PREFIXES if hasattr(cls, prefix)}
+    query = session.query(cls).outerjoin(cls.address)
+    for prefix, user in users.items():
+        query = query.outerjoin(user, getattr(cls, prefix))
+    query = (
+        query.options(
+            contains_eager(cls.address),
+            *[
+                contains_eager(getattr(cls, prefix), alias=user)
+                for prefix, user in users.items()
+            ],
+        )
+        .filter(cls.created_at >= START_DATE, cls.created_at <= date.today())
+        .order_by(cls.created_at.asc())
+    )
+    for batch in iter_batches(query):
+        load_categories(cls, batch)
+        for record in batch:
+            yield RecordRow(record).as_list()
+
+
+def sql_rows(cls):
+    query = detail_query(cls, START_DATE, date.today(), None, None)
+    return (list(row) for row in query)
+
+
+def without_categories(rows):
+    col = CSV_COLS.index("categories")
+    return [row[:col] + row[col + 1 :] for row in rows]
+
+
+def timed(rows):
+    start = time.perf_counter()
+    for _ in range(ITER):
+        size = sum(len(chunk) for chunk in CsvExport(CSV_COLS, rows()).iter_rows())
+        session.remove()
+    return (time.perf_counter() - start) / ITER * 1000, size
+
+
+if __name__ == "__main__":
+    print("table,orm_ms,sql_ms,bytes")
+    for cls in (Calls, Issues):
+        expected = without_categories(orm_rows(cls))
+        assert without_categories(sql_rows(cls)) == expected, cls.__tablename__
+        orm_ms, size = timed(lambda: orm_rows(cls))
+        sql_ms, _ = timed(lambda: sql_rows(cls))
+        print("%s,%f,%f,%d" % (cls.__tablename__, orm_ms, sql_ms, size))
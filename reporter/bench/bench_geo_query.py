@@ -0,0 +1,105 @@
+# Regression check for the geo report query: runs EXPLAIN ANALYZE on
+# point_counts and on the union of per-record array_agg queries it replaced,
+# for a few typical filters, and fails if point_counts has become slower.
+#
+#   python -m reporter.bench.bench_geo_query
+#
+# Needs the DB_* settings for a database with calls and issues in it, e.g. a
+# seeded local Postgres. MAX_RATIO is how many times slower than the old query
+# point_counts may run before the check fails.
+
+import os
+import statistics
+from datetime import date, timedelta
+
+from sqlalchemy import func, union_all
+from sqlalchemy.dialects.postgresql import array_agg
+
+from reporter.database import db_session as session
+from reporter.models import Addresses, Calls, Categories, Issues
+from reporter.utils import point_counts, union_points
+
+ITER = int(os.getenv("TEST_ITER", 10))
+MAX_RATIO = float(os.getenv("MAX_RATIO", 1.0))
+
+FILTERS = [
+    ("year", date.today() - timedelta(days=365), date.today(), None, None),
+    ("all", date(2000, 1, 1), date.today(), None, None),
+    ("category", date(2000, 1, 1), date.today(), "Repairs", None),
+    ("zip", date(2000, 1, 1), date.today(), None, "60622,60647"),
+]
+
+
+def call_issue_geog_query(cls, start_date, end_date, categories, zip_codes):
+    """The per-record query point_counts replaced, kept here for comparison"""
+    filter_list = [cls.created_at >= start_date, cls.created_at <= end_date]
+    if categories:
+        filter_list.append(Categories.name.in_(categories.split(",")))
+    if zip_codes:
+        filter_list.append(Addresses.zip.in_(zip_codes.split(",")))
+
+    return (
+        session.query(
+            array_agg(Categories.name).label("categories"),
+            cls.id.label("id"),
+            cls.created_at.label("created_at"),
+            Addresses.lat.label("lat"),
+            Addresses.lon.label("lon"),
+            Addresses.id.label("address_id"),
+        )
+        .outerjoin(cls.categories, Addresses)
+        .filter(*filter_list)
+        .order_by(cls.created_at.desc())
+        .group_by(cls.id, cls.created_at, Addresses)
+        .distinct(cls.id, cls.created_at)
+    )
+
+
+def records(*args):
+    return union_all(
+        call_issue_geog_query(Calls, *args), call_issue_geog_query(Issues, *args)
+    ).alias("call_issues")
+
+
+def explain(selectable):
+    """Return the median planning and execution ms and the rows returned"""
+    compiled = selectable.compile(dialect=session.bind.dialect)
+    conn = session.connection()
+    runs = []
+    for _ in range(ITER):
+        (plan,) = conn.execute(
+            "EXPLAIN (ANALYZE, FORMAT JSON) " + str(compiled), compiled.params
+        ).scalar()
+        runs.append(
+            (plan["Planning Time"], plan["Execution Time"], plan["Plan"]["Actual Rows"])
+        )
+    return (
+        statistics.median(r[0] for r in runs),
+        statistics.median(r[1] for r in runs),
+        runs[0][2],
+    )
+
+
+if __name__ == "__main__":
+    print("filter,query,planning_ms,execution_ms,rows")
+    slower = []
+    for name, *args in FILTERS:
+        old = records(*args)
+        new = union_points(point_counts(*args))
+        expected = session.query(func.count()).select_from(old).scalar()
+        total = (
+            session.query(func.coalesce(func.sum(new.c.count), 0))
+            .filter(new.c.total)
+            .scalar()
+        )
+        assert total == expected, (name, total, expected)
+
+        results = {}
+        for query, selectable in (("union", old.select()), ("points", new.select())):
+            results[query] = explain(selectable)
+            print("%s,%s,%f,%f,%d" % ((name, query) + results[query]))
+        if sum(results["points"][:2]) > sum(results["union"][:2]) * MAX_RATIO:
+            slower.append(name)
+    session.remove()
+    if slower:
+        raise SystemExit("point_counts is slower for: " + ", ".join(slower))
@@ -0,0 +1,57 @@
+# Compares counting a geo report from the database with counting it from a
+# snapshot written by export_snapshot, for a few typical filters.
+#
+#   python -m reporter.bench.bench_snapshot
+#
+# Needs the DB_* settings for a database with calls and issues in it. The
+# snapshot is written to a temporary directory.
+
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from reporter.aggregation import count_records
+from reporter.geography import get_geography
+from reporter.snapshot import Snapshot, export_snapshot
+from reporter.utils import point_counts
+
+ITER = int(os.getenv("TEST_ITER", 20))
+
+FILTERS = [
+    ("year", date.today() - timedelta(days=365), date.today(), None, None),
+    ("all", date(2000, 1, 1), date.today(), None, None),
+    ("category", date(2000, 1, 1), date.today(), ["Repairs"], None),
+    ("zip", date(2000, 1, 1), date.today(), None, ["60622", "60647"]),
+]
+
+
+def live(geography, start_date, end_date, categories, zip_codes):
+    categories = ",".join(categories) if categories else None
+    zip_codes = ",".join(zip_codes) if zip_codes else None
+    tables = point_counts(start_date, end_date, categories, zip_codes)
+    return count_records(geography, tables)
+
+
+def timed(f):
+    start = time.perf_counter()
+    for _ in range(ITER):
+        result = f()
+    return (time.perf_counter() - start) / ITER * 1000, result
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        records = export_snapshot(path)
+        print("export,%d records,%f s" % (records, time.perf_counter() - start))
+        snapshot = Snapshot(path)
+
+        print("filter,geog,live_ms,snapshot_ms")
+        for name, *args in FILTERS:
+            for geog in ("wards", "zips"):
+                geography = get_geography(geog)
+                live_ms, expected = timed(lambda: live(geography, *args))
+                snapshot_ms, result = timed(lambda: snapshot.counts(geography, *args))
+                assert result == expected, (name, geog)
+                print("%s,%s,%f,%f" % (name, geog, live_ms, snapshot_ms))
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Seconds before results for date ranges that include today are recomputed
+DEFAULT_TTL = 300
+DEFAULT_SIZE = 128
+DEFAULT_PATH = "/tmp/reporter_cache.sqlite3"
+
+
+class MemoryCache:
+    """In-process LRU cache of aggregation results with optional expiry"""
+
+    def __init__(self, max_entries=DEFAULT_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache:
+    """Aggregation results stored as JSON in SQLite, shared by processes on a host
+
+    On Lambda the file lives in /tmp, so entries survive as long as the container
+    does. Errors reading or writing the file are logged and treated as misses.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS aggregations "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+                )
+        except sqlite3.Error:
+            logger.warning("Could not create aggregation cache", exc_info=True)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT value FROM aggregations "
+                    "WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                    (key, time.time()),
+                ).fetchone()
+        except sqlite3.Error:
+            logger.warning("Could not read aggregation cache", exc_info=True)
+            return None
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM aggregations WHERE expires <= ?", (now,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO aggregations (key, value, expires) "
+                    "VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires),
+                )
+        except sqlite3.Error:
+            logger.warning("Could not write aggregation cache", exc_info=True)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def load_cache(backend=None):
+    """Create the cache selected by AGGREGATION_CACHE, or None if it's disabled"""
+    if backend is None:
+        backend = os.getenv("AGGREGATION_CACHE", "memory")
+    if backend == "memory":
+        return MemoryCache(int(os.getenv("AGGREGATION_CACHE_SIZE", DEFAULT_SIZE)))
+    if backend == "sqlite":
+        return SQLiteCache(os.getenv("AGGREGATION_CACHE_PATH", DEFAULT_PATH))
+    if backend in ("", "none"):
+        return None
+    raise ValueError("Unknown aggregation cache backend {!r}".format(backend))
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = load_cache() or False
+    return _cache or None
+
+
+def split_param(value):
+    """Normalize a comma separated request parameter to a sorted, deduplicated list"""
+    return sorted(set(value.split(","))) if value else None
+
+
+def cache_key(kind, start_date, end_date, **params):
+    """Build a key for an aggregation over a date range and normalized params"""
+    return json.dumps(
+        [kind, start_date.isoformat(), end_date.isoformat(), params], sort_keys=True
+    )
+
+
+def cache_ttl(end_date):
+    """Historical ranges can be kept forever, but ranges including today change"""
+    if end_date < date.today():
+        return None
+    return int(os.getenv("AGGREGATION_CACHE_TTL", DEFAULT_TTL))
+
+
+def cached(kind, start_date, end_date, compute, **params):
+    """Return compute() for an aggregation, reusing a cached result if there is one
+
+    Results have to be JSON serializable so they can be stored by any backend.
+    """
+    cache = get_cache()
+    if cache is None:
+        return compute()
+    key = cache_key(kind, start_date, end_date, **params)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, cache_ttl(end_date))
+    return value
@@ -0,0 +1,57 @@
+import threading
+
+import numpy as np
+
+from .database import db_session as session
+from .models import Categories
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class CategoryIndex:
+    """Category names by id, with each id mapped to a column of count matrices"""
+
+    def __init__(self, rows):
+        rows = sorted(rows)
+        self.ids = [category_id for category_id, _ in rows]
+        self.names = [name for _, name in rows]
+        self._columns = np.full(max(self.ids, default=-1) + 2, -1, dtype=np.intp)
+        self._columns[self.ids] = np.arange(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def knows(self, ids):
+        """Whether every id in an int array has a column"""
+        ids = np.asarray(ids, dtype=np.int64)
+        return bool(np.all(self.columns(ids) >= 0))
+
+    def columns(self, ids):
+        """Return the column of each id in an int array, or -1 for unknown ones"""
+        ids = np.asarray(ids, dtype=np.int64)
+        known = (ids >= 0) & (ids < len(self._columns) - 1)
+        return np.where(known, self._columns[np.where(known, ids, -1)], -1)
+
+    def region_dicts(self, matrix):
+        """Return a {name: count} dict of the non-zero counts in each matrix row"""
+        return [
+            {self.names[col]: int(row[col]) for col in np.flatnonzero(row).tolist()}
+            for row in matrix
+        ]
+
+
+def get_category_index(ids=()):
+    """Return the process-wide CategoryIndex, loading it once
+
+    The categories table is read again if any of ids is missing from it, so
+    categories added while the process runs are still counted.
+    """
+    global _index
+    index = _index
+    if index is None or not index.knows(ids):
+        with _index_lock:
+            if _index is None or not _index.knows(ids):
+                _index = CategoryIndex(session.query(Categories.id, Categories.name))
+            index = _index
+    return index
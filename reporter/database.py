@@ -1,16 +1,20 @@
 import os
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import URL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+# No connection is made until the first query, so the package can be imported
+# without the DB_* settings
 engine = create_engine(
-    "postgres://{}:{}@{}:{}/{}".format(
-        os.getenv("DB_USER"),
-        os.getenv("DB_PASS"),
-        os.getenv("DB_HOST"),
-        os.getenv("DB_PORT"),
-        os.getenv("DB_NAME"),
+    URL(
+        "postgres",
+        username=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        database=os.getenv("DB_NAME"),
     ),
     convert_unicode=True,
     server_side_cursors=True,
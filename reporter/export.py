@@ -1,5 +1,12 @@
 import csv
-from io import BytesIO, StringIO
+from io import StringIO
+from time import time
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import and_, case, func, literal, null, select
+from sqlalchemy.dialects.postgresql import array_agg
+
+from .models import Addresses, Categories
 
 CSV_COLS = [
     "id",
@@ -99,66 +106,87 @@ EVICTION_COLS = [
 ]
 
 
-class RecordRow:
-    def __init__(self, row, cols=CSV_COLS):
-        self.cols = cols
-        for col in self.cols:
-            col_prefix = col.split("_")[0]
-            if col == "call_issue":
-                attr = "issue" if getattr(row, "title", None) else "call"
-            elif col_prefix in USER_PREFIXES:
-                attr_name = col[len(col_prefix) + 1 :]
-                user_obj = getattr(row, col_prefix, None)
-                if user_obj:
-                    attr = getattr(user_obj, attr_name, None)
-                else:
-                    attr = None
-            elif col == "categories":
-                categories = getattr(row, "categories", [])
-                attr = ", ".join([getattr(c, "name", "") for c in categories])
-            elif col in ADDRESS_COLS:
-                if hasattr(row, "address"):
-                    attr = getattr(row.address, col, None)
-                else:
-                    attr = None
-            else:
-                attr = getattr(row, col, None)
-            setattr(self, col, attr)
-
-    def as_list(self):
-        return [getattr(self, c, "") for c in self.cols]
-
-
-class EvictionRecordRow(RecordRow):
-    def __init__(self, row, cols=EVICTION_COLS):
-        self.cols = EVICTION_COLS
-        for col in self.cols:
-            setattr(self, col, getattr(row, col, None))
-        call = None
-        if len(row.calls):
-            call = sorted(row.calls, key=lambda c: c.created_at)[-1]
-        call_row = RecordRow(call, cols=CSV_COLS)
-        self.cols = EVICTION_COLS + [f"call_{col}" for col in CSV_COLS]
-        for col in CSV_COLS:
-            setattr(self, f"call_{col}", getattr(call_row, col))
+def category_names(cls):
+    """Return a subquery of each call or issue id with its joined category names"""
+    relationship = cls.categories.property
+    record_id = relationship.secondary.c[relationship.primaryjoin.right.name]
+    return (
+        select(
+            [
+                record_id.label("id"),
+                func.array_to_string(array_agg(Categories.name), ", ").label("names"),
+            ]
+        )
+        .where(relationship.secondaryjoin)
+        .group_by(record_id)
+        .alias()
+    )
+
+
+def record_columns(cls, users, categories, cols=CSV_COLS):
+    """Return labelled SQL expressions selecting cols for a call, issue or record
+
+    call_issue is "issue" for records with a non-empty title and "call" for the
+    rest, like calls, which have no title. Columns starting with one of
+    USER_PREFIXES come from the User alias users maps that prefix to, categories
+    from the joined category_names subquery, and ADDRESS_COLS from Addresses.
+    Columns cls doesn't have are selected as NULL so rows always line up with
+    cols.
+    """
+    columns = []
+    for col in cols:
+        col_prefix = col.split("_")[0]
+        if col == "call_issue":
+            expr = literal("call")
+            if hasattr(cls, "title"):
+                has_title = and_(cls.title.isnot(None), cls.title != "")
+                expr = case([(has_title, "issue")], else_=expr)
+        elif col_prefix in USER_PREFIXES:
+            user = users.get(col_prefix)
+            expr = getattr(user, col[len(col_prefix) + 1 :], None)
+        elif col == "categories":
+            expr = categories.c.names
+        elif col in ADDRESS_COLS:
+            expr = getattr(Addresses, col)
+        else:
+            expr = getattr(cls, col, None)
+        columns.append((null() if expr is None else expr).label(col))
+    return columns
 
 
 class CsvExport:
-    """Accepts columns and a list of lists for writing to BytesIO CSV"""
+    """Accepts columns and an iterable of lists for streaming as CSV"""
+
+    # Approximate number of characters buffered before a chunk is yielded
+    chunk_size = 64 * 1024
 
     def __init__(self, cols, rows):
         self.cols = cols
         self.rows = rows
 
-    def write_rows(self):
-        """Return BytesIO object with data"""
+    def iter_rows(self):
+        """Yield the CSV as UTF-8 encoded chunks, consuming rows as it goes"""
         proxy = StringIO()
-        mem = BytesIO()
         writer = csv.writer(proxy)
         writer.writerow(self.cols)
         for row in self.rows:
             writer.writerow(row)
-        mem.write(proxy.getvalue().encode("utf-8"))
-        mem.seek(0)
+            if proxy.tell() >= self.chunk_size:
+                yield proxy.getvalue().encode("utf-8")
+                proxy.seek(0)
+                proxy.truncate()
+        yield proxy.getvalue().encode("utf-8")
         proxy.close()
-        return mem
+
+    def response(self, filename):
+        """Return a streamed attachment response with the same headers as send_file"""
+        response = Response(
+            stream_with_context(self.iter_rows()),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+        max_age = current_app.get_send_file_max_age(filename)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.expires = int(time() + max_age)
+        return response
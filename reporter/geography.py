@@ -0,0 +1,753 @@
+import abc
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from functools import partial
+
+import numpy as np
+from shapely import vectorized
+from shapely.geometry import MultiPolygon, Point, Polygon, shape
+from shapely.prepared import prep
+
+from .pyrtree import Rect, RTree
+
+logger = logging.getLogger(__name__)
+
+GEOGRAPHIES = {
+    "wards": ("chi_wards.geojson", "ward"),
+    "zips": ("chi_zips.geojson", "zip"),
+}
+
+# Cells per side of the grid laid over each region's bounding box
+REGION_CELLS = 64
+# Cells per side of the grid laid over a whole geography by GridRegionIndex
+GRID_CELLS = 512
+
+EXTERIOR, INTERIOR, BOUNDARY = 0, 1, 2
+
+# Points in one assign call from which it's split across worker processes
+DEFAULT_PARALLEL_ROWS = 20000
+# Seconds to wait for the workers before assigning the points serially
+DEFAULT_ASSIGN_TIMEOUT = 60
+
+BOUNDARY_VERSION = 2
+DEFAULT_BOUNDARY_DIR = os.path.join(os.path.dirname(__file__), "compiled")
+
+_geographies = {}
+_geographies_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Points tested against boundaries, and how many of them were distinct
+_dedup_counts = {"points": 0, "unique": 0}
+_dedup_lock = threading.Lock()
+
+
+def classify_cells(shp, prepared, origin, cell_size, grid_shape):
+    """Classify each cell of a grid as EXTERIOR, INTERIOR or BOUNDARY to shp
+
+    Cells are marked BOUNDARY by sampling every ring at less than a cell's width
+    and widening the marked cells by one in each direction, so any cell the
+    boundary passes through is BOUNDARY. The rest lie entirely on one side of
+    the boundary and are classified by testing their centers.
+    """
+    minx, miny = origin
+    width, height = cell_size
+    nx, ny = grid_shape
+    step = min(width, height) / 2
+    polygons = shp.geoms if shp.geom_type == "MultiPolygon" else [shp]
+    rings = [ring for poly in polygons for ring in [poly.exterior, *poly.interiors]]
+    samples = np.concatenate([_ring_samples(np.asarray(r.coords), step) for r in rings])
+    ix = np.floor((samples[:, 0] - minx) / width).astype(np.intp)
+    iy = np.floor((samples[:, 1] - miny) / height).astype(np.intp)
+    on_grid = (ix >= -1) & (ix <= nx) & (iy >= -1) & (iy <= ny)
+    crossed = np.zeros((nx + 2, ny + 2), dtype=bool)
+    crossed[ix[on_grid] + 1, iy[on_grid] + 1] = True
+    boundary = np.zeros((nx, ny), dtype=bool)
+    for dx in range(3):
+        for dy in range(3):
+            boundary |= crossed[dx : dx + nx, dy : dy + ny]
+
+    cells = np.full((nx, ny), EXTERIOR, dtype=np.int8)
+    cells[boundary] = BOUNDARY
+    cx, cy = np.nonzero(~boundary)
+    inside = vectorized.contains(
+        prepared, minx + (cx + 0.5) * width, miny + (cy + 0.5) * height
+    )
+    cells[cx[inside], cy[inside]] = INTERIOR
+    return cells
+
+
+def _ring_samples(coords, step):
+    """Return points along a ring spaced no more than step apart"""
+    start = coords[:-1]
+    delta = coords[1:] - start
+    counts = np.maximum(np.ceil(np.hypot(delta[:, 0], delta[:, 1]) / step), 1)
+    counts = counts.astype(np.intp)
+    segment = np.repeat(np.arange(len(start)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    frac = offsets / counts[segment]
+    return start[segment] + delta[segment] * frac[:, np.newaxis]
+
+
+def dedup_points(xs, ys):
+    """Return where each distinct point first occurs and each point's distinct index
+
+    Points are distinct by their exact coordinates. The counts are added to
+    dedup_stats.
+    """
+    _, first, inverse = np.unique(xs + 1j * ys, return_index=True, return_inverse=True)
+    _count_dedup(len(xs), len(first))
+    logger.debug("Testing %d distinct points of %d", len(first), len(xs))
+    return first, inverse.reshape(-1)
+
+
+def _count_dedup(points, unique):
+    with _dedup_lock:
+        _dedup_counts["points"] += points
+        _dedup_counts["unique"] += unique
+
+
+def dedup_stats():
+    """Return how many points this process tested against boundaries
+
+    Points assign_parallel sent to worker processes are included. hit_rate is
+    the share of them skipped because an earlier point in the same batch had the
+    same coordinates.
+    """
+    with _dedup_lock:
+        stats = dict(_dedup_counts)
+    stats["hit_rate"] = (
+        1 - stats["unique"] / stats["points"] if stats["points"] else 0.0
+    )
+    return stats
+
+
+def log_dedup_stats(since):
+    """Log the points tested against boundaries since an earlier dedup_stats()"""
+    stats = dedup_stats()
+    points = stats["points"] - since["points"]
+    if points:
+        unique = stats["unique"] - since["unique"]
+        logger.info(
+            "Tested %d distinct points of %d against boundaries, hit rate %.3f",
+            unique,
+            points,
+            1 - unique / points,
+        )
+
+
+class PreparedRegion:
+    """A region polygon with a prepared geometry and a grid of precomputed cells
+
+    Points in INTERIOR cells are accepted and points in EXTERIOR cells rejected
+    without touching the geometry, only points in BOUNDARY cells are tested
+    against the prepared polygon.
+    """
+
+    def __init__(self, shp, cells_per_side=REGION_CELLS):
+        self._shape = shp
+        self._prepared = None
+        self.bounds = shp.bounds
+        minx, miny, maxx, maxy = self.bounds
+        self.origin = (minx, miny)
+        self.cell_size = (
+            (maxx - minx) / cells_per_side or 1.0,
+            (maxy - miny) / cells_per_side or 1.0,
+        )
+        self.cells = classify_cells(
+            shp,
+            self.prepared,
+            self.origin,
+            self.cell_size,
+            (cells_per_side, cells_per_side),
+        )
+
+    @classmethod
+    def from_cells(cls, load_shape, bounds, origin, cell_size, cells):
+        """Return a region with precomputed cells, calling load_shape on first use"""
+        region = cls.__new__(cls)
+        region._shape = None
+        region._prepared = None
+        region._load_shape = load_shape
+        region.bounds = bounds
+        region.origin = origin
+        region.cell_size = cell_size
+        region.cells = cells
+        return region
+
+    # Built on first use. Threads racing here build equal geometries, so
+    # sharing a region between threads stays safe.
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = self._load_shape()
+        return self._shape
+
+    @property
+    def prepared(self):
+        if self._prepared is None:
+            self._prepared = prep(self.shape)
+        return self._prepared
+
+    def _cell_states(self, xs, ys):
+        nx, ny = self.cells.shape
+        ix = np.floor((xs - self.origin[0]) / self.cell_size[0]).astype(np.intp)
+        iy = np.floor((ys - self.origin[1]) / self.cell_size[1]).astype(np.intp)
+        return self.cells[np.clip(ix, 0, nx - 1), np.clip(iy, 0, ny - 1)]
+
+    def contains(self, x, y):
+        state = self._cell_states(np.array([x]), np.array([y]))[0]
+        if state == BOUNDARY:
+            return self.prepared.contains(Point(x, y))
+        return state == INTERIOR
+
+    def contains_many(self, xs, ys):
+        """Return a mask of the points inside the region, xs and ys within bounds"""
+        states = self._cell_states(xs, ys)
+        inside = states == INTERIOR
+        boundary = np.flatnonzero(states == BOUNDARY)
+        if len(boundary):
+            # Points in the same place are only tested against the polygon once
+            first, inverse = dedup_points(xs[boundary], ys[boundary])
+            boundary_inside = vectorized.contains(
+                self.prepared, xs[boundary][first], ys[boundary][first]
+            )
+            inside[boundary] = boundary_inside[inverse]
+        return inside
+
+
+class RegionIndex(abc.ABC):
+    """Maps points to the index of the region containing them
+
+    Backends are built from a sequence of PreparedRegion and are read-only once
+    built, so a single instance can be shared between threads.
+    """
+
+    def __init__(self, regions):
+        self.regions = regions
+
+    def locate(self, x, y):
+        """Return the index of the region containing a point, or None"""
+        idx = self.assign(np.array([x], dtype=float), np.array([y], dtype=float))[0]
+        return None if idx < 0 else int(idx)
+
+    @abc.abstractmethod
+    def assign(self, xs, ys):
+        """Return the region index for each point in float arrays, or -1"""
+
+    @abc.abstractmethod
+    def save(self, path):
+        """Write the index into the directory of a compiled geography"""
+
+    @classmethod
+    @abc.abstractmethod
+    def load(cls, regions, path):
+        """Return the index written by save, for the same regions"""
+
+
+class RTreeRegionIndex(RegionIndex):
+    """Region lookup through pyrtree, kept for comparison with the grid"""
+
+    def __init__(self, regions):
+        super().__init__(regions)
+        self.tree = RTree.bulk_load(
+            (idx, Rect(*region.bounds)) for idx, region in enumerate(regions)
+        )
+        self.leaf_regions = np.array(self.tree.leaf_pool, dtype=np.intp)
+
+    def save(self, path):
+        self.tree.save(os.path.join(path, "rtree.bin"))
+
+    @classmethod
+    def load(cls, regions, path):
+        index = cls.__new__(cls)
+        RegionIndex.__init__(index, regions)
+        index.tree = RTree.load(os.path.join(path, "rtree.bin"))
+        index.leaf_regions = np.array(index.tree.leaf_pool, dtype=np.intp)
+        return index
+
+    def locate(self, x, y):
+        # query_point_ids doesn't use the tree's shared cursor, so it's thread-safe
+        for leaf in self.tree.query_point_ids((x, y)):
+            idx = self.tree.leaf_pool[leaf]
+            if self.regions[idx].contains(x, y):
+                return idx
+        return None
+
+    def assign(self, xs, ys):
+        assigned = np.full(xs.shape, -1, dtype=np.intp)
+        valid = np.flatnonzero(~(np.isnan(xs) | np.isnan(ys)))
+        first, inverse = dedup_points(xs[valid], ys[valid])
+        ux = xs[valid][first]
+        uy = ys[valid][first]
+        offsets, leaves = self.tree.query_points(ux, uy)
+        points = np.repeat(np.arange(len(ux)), np.diff(offsets))
+        candidates = self.leaf_regions[leaves]
+        found = np.full(ux.shape, -1, dtype=np.intp)
+        for idx in np.unique(candidates).tolist():
+            pts = points[candidates == idx]
+            pts = pts[found[pts] < 0]
+            found[pts[self.regions[idx].contains_many(ux[pts], uy[pts])]] = idx
+        assigned[valid] = found[inverse]
+        return assigned
+
+
+class GridRegionIndex(RegionIndex):
+    """Region lookup through a uniform grid over the extent of all regions
+
+    Each cell is either owned outright by the one region containing all of it,
+    or lists the regions whose boundaries pass through it. A point's cell is
+    found by arithmetic, so most points are assigned without any geometry and
+    the rest are only tested against their cell's few candidate regions.
+    """
+
+    ARRAYS = ("owner", "candidates", "offsets")
+
+    def __init__(self, regions, cells_per_side=GRID_CELLS):
+        super().__init__(regions)
+        self._set_extent(cells_per_side)
+        minx, miny = self.origin
+        self.owner = np.full((cells_per_side, cells_per_side), -1, dtype=np.int16)
+
+        candidate_cells = []
+        candidate_regions = []
+        for idx, region in enumerate(regions):
+            ix0, iy0, ix1, iy1 = self._cell_range(*region.bounds)
+            cells = classify_cells(
+                region.shape,
+                region.prepared,
+                (minx + ix0 * self.cell_size[0], miny + iy0 * self.cell_size[1]),
+                self.cell_size,
+                (ix1 - ix0 + 1, iy1 - iy0 + 1),
+            )
+            self.owner[ix0 : ix1 + 1, iy0 : iy1 + 1][cells == INTERIOR] = idx
+            bx, by = np.nonzero(cells == BOUNDARY)
+            candidate_cells.append((bx + ix0) * cells_per_side + by + iy0)
+            candidate_regions.append(np.full(len(bx), idx, dtype=np.intp))
+
+        # Candidate regions per cell, stored as offsets into one flat array
+        candidate_cells = np.concatenate(candidate_cells)
+        order = np.argsort(candidate_cells, kind="stable")
+        self.candidates = np.concatenate(candidate_regions)[order]
+        counts = np.bincount(candidate_cells, minlength=self.owner.size)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _set_extent(self, cells_per_side):
+        bounds = np.array([region.bounds for region in self.regions], dtype=float)
+        minx, miny = bounds[:, :2].min(axis=0)
+        maxx, maxy = bounds[:, 2:].max(axis=0)
+        self.origin = (minx, miny)
+        self.cell_size = (
+            (maxx - minx) / cells_per_side or 1.0,
+            (maxy - miny) / cells_per_side or 1.0,
+        )
+
+    def save(self, path):
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, "grid_{}.npy".format(name)), getattr(self, name))
+
+    @classmethod
+    def load(cls, regions, path):
+        index = cls.__new__(cls)
+        RegionIndex.__init__(index, regions)
+        for name in cls.ARRAYS:
+            path_name = os.path.join(path, "grid_{}.npy".format(name))
+            setattr(index, name, np.load(path_name, mmap_mode="r"))
+        index._set_extent(len(index.owner))
+        return index
+
+    def _cell_range(self, minx, miny, maxx, maxy):
+        nx, ny = self.owner.shape
+        ix0, iy0 = self._cell(minx, miny)
+        ix1, iy1 = self._cell(maxx, maxy)
+        return max(ix0, 0), max(iy0, 0), min(ix1, nx - 1), min(iy1, ny - 1)
+
+    def _cell(self, x, y):
+        return (
+            int((x - self.origin[0]) // self.cell_size[0]),
+            int((y - self.origin[1]) // self.cell_size[1]),
+        )
+
+    def assign(self, xs, ys):
+        nx, ny = self.owner.shape
+        assigned = np.full(xs.shape, -1, dtype=np.intp)
+        fx = (xs - self.origin[0]) / self.cell_size[0]
+        fy = (ys - self.origin[1]) / self.cell_size[1]
+        points = np.flatnonzero((fx >= 0) & (fx < nx) & (fy >= 0) & (fy < ny))
+        cells = fx[points].astype(np.intp) * ny + fy[points].astype(np.intp)
+        owners = self.owner.ravel()[cells]
+        assigned[points] = owners
+
+        unowned = owners < 0
+        points = points[unowned]
+        cells = cells[unowned]
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+        pair_points = np.repeat(points, counts)
+        pair_offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        pair_regions = self.candidates[np.repeat(starts, counts) + pair_offsets]
+        order = np.argsort(pair_regions, kind="stable")
+        pair_points = pair_points[order]
+        pair_regions = pair_regions[order]
+        region_ids, region_starts = np.unique(pair_regions, return_index=True)
+        for idx, candidates in zip(
+            region_ids, np.split(pair_points, region_starts[1:])
+        ):
+            candidates = candidates[assigned[candidates] < 0]
+            inside = self.regions[idx].contains_many(xs[candidates], ys[candidates])
+            assigned[candidates[inside]] = idx
+        return assigned
+
+
+REGION_INDEXES = {"grid": GridRegionIndex, "rtree": RTreeRegionIndex}
+
+
+class Geography:
+    """Boundaries and region index for one geography, shared across requests
+
+    Instances are built once per process and must not be mutated. Use
+    feature_collection() for a copy of the GeoJSON that can be counted into.
+    """
+
+    def __init__(self, name, regions, prepared, index, geojson_path):
+        self.name = name
+        self.regions = tuple(regions)
+        self.prepared = tuple(prepared)
+        self.index = index
+        self.geojson_path = geojson_path
+        self._geojson = None
+        self._geojson_lock = threading.Lock()
+
+    @classmethod
+    def from_geojson(cls, name, geojson_path, region_key, index_cls=GridRegionIndex):
+        """Build a geography by parsing its GeoJSON and classifying every region"""
+        with open(geojson_path, "r") as gf:
+            geojson = json.load(gf)
+        features = geojson["features"]
+        prepared = [PreparedRegion(shape(feat["geometry"])) for feat in features]
+        geography = cls(
+            name,
+            [feat["properties"][region_key] for feat in features],
+            prepared,
+            index_cls(prepared),
+            geojson_path,
+        )
+        geography._geojson = geojson
+        return geography
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def shapes(self):
+        return tuple(region.shape for region in self.prepared)
+
+    def locate(self, lon, lat):
+        """Return the index of the region containing a point, or None"""
+        return self.index.locate(lon, lat)
+
+    def assign(self, lons, lats):
+        """Return the region index for each point, or -1 if no region contains it
+
+        At least parallel_rows() points are split between worker processes, see
+        assign_parallel.
+        """
+        xs = np.asarray(lons, dtype=float)
+        ys = np.asarray(lats, dtype=float)
+        if len(xs) >= parallel_rows():
+            regions = assign_parallel(self.name, xs, ys)
+            if regions is not None:
+                return regions
+        return self.index.assign(xs, ys)
+
+    def geojson(self):
+        """Return the parsed GeoJSON, reading it on first use"""
+        if self._geojson is None:
+            with self._geojson_lock:
+                if self._geojson is None:
+                    with open(self.geojson_path, "r") as gf:
+                        self._geojson = json.load(gf)
+        return self._geojson
+
+    def feature_collection(self):
+        """Return a copy of the GeoJSON with per-request properties dicts"""
+        geojson = self.geojson()
+        return dict(
+            geojson,
+            features=[
+                dict(feat, properties=dict(feat["properties"]))
+                for feat in geojson["features"]
+            ],
+        )
+
+
+def geojson_path(geog):
+    filename, _ = GEOGRAPHIES[geog]
+    return os.path.join(os.path.dirname(__file__), "static", "js", filename)
+
+
+def boundary_dir():
+    return os.getenv("BOUNDARY_DIR", DEFAULT_BOUNDARY_DIR)
+
+
+def _source_stamp(path):
+    """Return the size and modification time that identify a GeoJSON file
+
+    Zip archives, like the deployment package, keep modification times to 2
+    seconds, so that's all that is compared.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime) // 2 * 2]
+
+
+def compile_geography(geog, path=None):
+    """Write a geography's boundaries and region indexes for load_compiled
+
+    Rings are stored as one array of coordinates with offsets per ring, per
+    polygon and per region, next to each region's bounds and grid of cells and
+    the files of both region indexes. meta.json is written last and records
+    the size and modification time of the GeoJSON they were built from.
+    """
+    _, region_key = GEOGRAPHIES[geog]
+    path = os.path.join(path or boundary_dir(), geog)
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    geography = Geography.from_geojson(geog, geojson_path(geog), region_key)
+    coords, rings, polygons, parts = [], [0], [0], [0]
+    for shp in geography.shapes:
+        for poly in shp.geoms if shp.geom_type == "MultiPolygon" else [shp]:
+            for ring in [poly.exterior, *poly.interiors]:
+                coords.append(np.asarray(ring.coords, dtype=float)[:, :2])
+                rings.append(rings[-1] + len(coords[-1]))
+            polygons.append(len(rings) - 1)
+        parts.append(len(polygons) - 1)
+    arrays = {
+        "coords": np.concatenate(coords),
+        "rings": np.array(rings, dtype=np.int64),
+        "polygons": np.array(polygons, dtype=np.int64),
+        "parts": np.array(parts, dtype=np.int64),
+        "bounds": np.array([r.bounds for r in geography.prepared], dtype=float),
+        "cell_grids": np.array(
+            [r.origin + r.cell_size for r in geography.prepared], dtype=float
+        ),
+        "cells": np.stack([r.cells for r in geography.prepared]),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    geography.index.save(path)
+    RTreeRegionIndex(geography.prepared).save(path)
+
+    meta = {
+        "version": BOUNDARY_VERSION,
+        "source": _source_stamp(geography.geojson_path),
+        "region_cells": REGION_CELLS,
+        "grid_cells": GRID_CELLS,
+        "regions": list(geography.regions),
+        "multi": [shp.geom_type == "MultiPolygon" for shp in geography.shapes],
+    }
+    with open(meta_path + ".tmp", "w") as mf:
+        json.dump(meta, mf)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _compiled_shape(arrays, idx, multi):
+    coords, rings, polygons, parts = (
+        arrays[name] for name in ("coords", "rings", "polygons", "parts")
+    )
+    polys = []
+    for p in range(parts[idx], parts[idx + 1]):
+        shell, *holes = [
+            np.array(coords[rings[r] : rings[r + 1]])
+            for r in range(polygons[p], polygons[p + 1])
+        ]
+        polys.append(Polygon(shell, holes))
+    return MultiPolygon(polys) if multi else polys[0]
+
+
+def load_compiled(geog, index_cls=GridRegionIndex, path=None):
+    """Return the Geography written by compile_geography, or None
+
+    Arrays are memory-mapped and shapes are only built for the regions whose
+    boundaries a point has to be tested against. Returns None when nothing was
+    compiled, or it was compiled from different GeoJSON or settings. The GeoJSON
+    isn't read, only its size and modification time are compared.
+    """
+    path = os.path.join(path or boundary_dir(), geog)
+    try:
+        with open(os.path.join(path, "meta.json")) as mf:
+            meta = json.load(mf)
+    except OSError:
+        return None
+    source = geojson_path(geog)
+    compiled = [
+        meta[key] for key in ("version", "region_cells", "grid_cells", "source")
+    ]
+    if compiled != [BOUNDARY_VERSION, REGION_CELLS, GRID_CELLS, _source_stamp(source)]:
+        logger.warning("Compiled %s boundaries are out of date, ignoring them", geog)
+        return None
+
+    arrays = {
+        name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        for name in (
+            "coords",
+            "rings",
+            "polygons",
+            "parts",
+            "bounds",
+            "cell_grids",
+            "cells",
+        )
+    }
+    prepared = []
+    for idx, multi in enumerate(meta["multi"]):
+        grid = arrays["cell_grids"][idx].tolist()
+        prepared.append(
+            PreparedRegion.from_cells(
+                partial(_compiled_shape, arrays, idx, multi),
+                tuple(arrays["bounds"][idx].tolist()),
+                tuple(grid[:2]),
+                tuple(grid[2:]),
+                arrays["cells"][idx],
+            )
+        )
+    index = index_cls.load(prepared, path)
+    return Geography(geog, meta["regions"], prepared, index, source)
+
+
+def load_geography(geog, index=None):
+    """Return a Geography from its compiled boundaries, or its GeoJSON if stale"""
+    index_cls = REGION_INDEXES[index or os.getenv("REGION_INDEX", "grid")]
+    geography = load_compiled(geog, index_cls)
+    if geography is None:
+        _, region_key = GEOGRAPHIES[geog]
+        geography = Geography.from_geojson(
+            geog, geojson_path(geog), region_key, index_cls=index_cls
+        )
+    return geography
+
+
+def get_geography(geog):
+    """Return the process-wide Geography for 'wards' or 'zips', building it once
+
+    The region index backend is picked by the REGION_INDEX environment variable,
+    one of REGION_INDEXES and "grid" by default.
+    """
+    geog = "zips" if geog == "zips" else "wards"
+    geography = _geographies.get(geog)
+    if geography is None:
+        with _geographies_lock:
+            geography = _geographies.get(geog)
+            if geography is None:
+                geography = load_geography(geog)
+                _geographies[geog] = geography
+    return geography
+
+
+def assign_regions(lons, lats, geog):
+    """Return the index of the containing region in geog for each lon/lat pair
+
+    Missing coordinates (None or NaN) and points outside every region get -1.
+    """
+    return get_geography(geog).assign(lons, lats)
+
+
+def parallel_rows():
+    return int(os.getenv("ASSIGN_PARALLEL_ROWS", DEFAULT_PARALLEL_ROWS))
+
+
+def assign_timeout():
+    return float(os.getenv("ASSIGN_TIMEOUT", DEFAULT_ASSIGN_TIMEOUT))
+
+
+def assign_workers():
+    """Return ASSIGN_WORKERS, or the number of CPUs this process may run on"""
+    workers = os.getenv("ASSIGN_WORKERS")
+    if workers:
+        return int(workers)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _new_pool(workers):
+    # Workers are forked from a server process rather than from this one, whose
+    # other threads may hold locks that a forked copy could never release. The
+    # server imports this module instead of re-running the main script.
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context.Pool(workers)
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(workers)
+        return _pool
+
+
+def _assign_chunk(geog, lons, lats):
+    # Each worker loads the geography once and keeps it for later chunks. It
+    # returns the dedup counts of the chunk to be added to the parent's.
+    before = dedup_stats()
+    regions = get_geography(geog).index.assign(lons, lats)
+    after = dedup_stats()
+    return (
+        regions,
+        after["points"] - before["points"],
+        after["unique"] - before["unique"],
+    )
+
+
+def assign_parallel(geog, lons, lats):
+    """Assign float arrays of points in chunks across a process pool
+
+    The pool is started on first use and kept for the life of the process,
+    with one worker per available CPU. Returns None when there is only one, or
+    when worker processes can't be used, in which case the caller assigns the
+    points itself. That's the case on hosts without /dev/shm, and once a chunk
+    fails or takes longer than assign_timeout(), as when a worker is killed,
+    after which the pool is shut down.
+    """
+    global _pool
+    workers = assign_workers()
+    if workers < 2 or _pool is False:
+        return None
+    chunks = np.array_split(np.arange(len(lons)), workers)
+    try:
+        pool = _get_pool(workers)
+    except OSError:
+        logger.warning("Assigning regions serially", exc_info=True)
+        with _pool_lock:
+            _pool = False
+        return None
+    try:
+        results = pool.starmap_async(
+            _assign_chunk, [(geog, lons[chunk], lats[chunk]) for chunk in chunks]
+        ).get(assign_timeout())
+    except Exception:
+        # A worker that dies is replaced, but its chunk is never returned
+        logger.warning("Worker processes failed, assigning serially", exc_info=True)
+        pool.terminate()
+        with _pool_lock:
+            _pool = False
+        return None
+    for _, points, unique in results:
+        _count_dedup(points, unique)
+    return np.concatenate([regions for regions, _, _ in results])
+
+
+def warm_geographies():
+    """Build every geography up front, e.g. at import time on a Lambda cold start"""
+    for geog in GEOGRAPHIES:
+        get_geography(geog)
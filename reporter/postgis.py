@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import threading
+
+from psycopg2 import errors
+from sqlalchemy import Column, Integer, MetaData, String, Table, and_, func, text
+from sqlalchemy.exc import DBAPIError
+
+from .categories import get_category_index
+from .database import db_session as session
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+regions_table = Table(
+    "reporter_regions",
+    MetaData(),
+    Column("kind", String, primary_key=True),
+    Column("idx", Integer, primary_key=True),
+    Column("region", String),
+    Column("digest", String),
+    Column("geom"),
+)
+
+CREATE_REGIONS = """
+CREATE TABLE IF NOT EXISTS reporter_regions (
+    kind varchar NOT NULL,
+    idx integer NOT NULL,
+    region varchar NOT NULL,
+    digest varchar NOT NULL,
+    geom geometry(Geometry, 4326) NOT NULL,
+    PRIMARY KEY (kind, idx)
+);
+CREATE INDEX IF NOT EXISTS reporter_regions_geom_idx
+    ON reporter_regions USING gist (geom);
+"""
+
+# Geographies whose boundaries have been loaded into PostGIS by this process
+_loaded = set()
+_loaded_lock = threading.Lock()
+# Set once the database turns out not to have PostGIS
+_unavailable = False
+
+# Errors from a database without the PostGIS types and functions
+MISSING_POSTGIS = (errors.UndefinedFunction, errors.UndefinedObject)
+
+
+def postgis_enabled():
+    return bool(os.getenv("POSTGIS_REGIONS"))
+
+
+def geography_digest(geography):
+    digest = hashlib.sha1()
+    for shp in geography.shapes:
+        digest.update(shp.wkb)
+    return digest.hexdigest()
+
+
+def _load_regions(conn, geography, digest):
+    conn.execute(regions_table.delete().where(regions_table.c.kind == geography.name))
+    conn.execute(
+        text(
+            "INSERT INTO reporter_regions (kind, idx, region, digest, geom) "
+            "VALUES (:kind, :idx, :region, :digest, ST_GeomFromText(:wkt, 4326))"
+        ),
+        [
+            {
+                "kind": geography.name,
+                "idx": idx,
+                "region": region,
+                "digest": digest,
+                "wkt": shp.wkt,
+            }
+            for idx, (region, shp) in enumerate(
+                zip(geography.regions, geography.shapes)
+            )
+        ],
+    )
+
+
+def regions_loaded(geography):
+    """Make sure the boundaries for a geography are in PostGIS, loading them once
+
+    Returns False if PostGIS is not enabled or not usable, in which case callers
+    should fall back to the in-process region index. A database without PostGIS
+    isn't tried again, other errors, like a lost connection or another process
+    loading the same boundaries, only affect this call.
+    """
+    global _unavailable
+    if not postgis_enabled() or _unavailable:
+        return False
+    if geography.name in _loaded:
+        return True
+    with _loaded_lock:
+        if geography.name not in _loaded and not _unavailable:
+            digest = geography_digest(geography)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(CREATE_REGIONS))
+                    current = conn.execute(
+                        text(
+                            "SELECT count(*), min(digest), max(digest) "
+                            "FROM reporter_regions WHERE kind = :kind"
+                        ),
+                        kind=geography.name,
+                    ).first()
+                    if tuple(current) != (len(geography), digest, digest):
+                        _load_regions(conn, geography, digest)
+                _loaded.add(geography.name)
+            except DBAPIError as exc:
+                logger.warning(
+                    "PostGIS regions unavailable, using in-process index", exc_info=True
+                )
+                if isinstance(exc.orig, MISSING_POSTGIS):
+                    _unavailable = True
+    return geography.name in _loaded
+
+
+def _region_join(geography, points):
+    # Points outside every region are kept, with a NULL region
+    point = func.ST_SetSRID(func.ST_MakePoint(points.c.lon, points.c.lat), 4326)
+    return points.outerjoin(
+        regions_table,
+        and_(
+            regions_table.c.kind == geography.name,
+            func.ST_Contains(regions_table.c.geom, point),
+        ),
+    )
+
+
+def region_point_counts(geography, points):
+    """Count point_counts records per region inside the database
+
+    points is the union of the point_counts subqueries. Totals, category counts
+    and the records outside every region all come from one grouped query, so
+    the union is only scanned once. Returns the fields of an AggregationResult
+    as a dict, or None when they should be computed in-process instead.
+    """
+    if not regions_loaded(geography):
+        return None
+    try:
+        rows = (
+            session.query(
+                regions_table.c.idx,
+                points.c.total,
+                points.c.category_id,
+                func.sum(points.c.count),
+            )
+            .select_from(_region_join(geography, points))
+            .group_by(regions_table.c.idx, points.c.total, points.c.category_id)
+            .all()
+        )
+    except DBAPIError:
+        session.rollback()
+        logger.warning("PostGIS region counts failed", exc_info=True)
+        return None
+
+    totals = [0] * len(geography)
+    unassigned = 0
+    category_rows = []
+    for idx, total, category_id, count in rows:
+        if total and idx is None:
+            unassigned += int(count)
+        elif total:
+            totals[idx] += int(count)
+        elif idx is not None and category_id is not None:
+            category_rows.append((idx, category_id, int(count)))
+    index = get_category_index([category_id for _, category_id, _ in category_rows])
+    names = dict(zip(index.ids, index.names))
+    category_counts = [{} for _ in range(len(geography))]
+    for idx, category_id, count in category_rows:
+        category_counts[idx][names[category_id]] = count
+    return {
+        "totals": totals,
+        "category_counts": category_counts,
+        "unassigned": unassigned,
+    }
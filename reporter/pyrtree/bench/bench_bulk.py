@@ -0,0 +1,55 @@
+# Compares building a tree with repeated inserts against bulk_load, and
+# against opening a saved copy with load.
+# Run from this directory: TEST_ITER=10000 python bench_bulk.py
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rect import Rect
+from pyrtree.rtree import RTree
+
+import os
+import random
+import tempfile
+import time
+
+ITER=10000
+if "TEST_ITER" in os.environ:
+    ITER=int(os.getenv("TEST_ITER"))
+
+if __name__ == "__main__":
+    random.seed(0)
+    items = []
+    for v in range(ITER):
+        x, y = random.uniform(0.0, 10.0), random.uniform(0.0, 10.0)
+        items.append((v, Rect(x, y, x + 0.01, y + 0.01)))
+
+    t = time.perf_counter()
+    rt = RTree()
+    for v, r in items:
+        rt.insert(v, r)
+    insert_t = time.perf_counter() - t
+
+    t = time.perf_counter()
+    bt = RTree.bulk_load(items)
+    bulk_t = time.perf_counter() - t
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    bt.save(path)
+    t = time.perf_counter()
+    lt = RTree.load(path)
+    load_t = time.perf_counter() - t
+    t = time.perf_counter()
+    ct = RTree.load(path, mmap=False)
+    copy_t = time.perf_counter() - t
+    os.remove(path)
+
+    # rects, build, total time, nodes
+    print("%d,%s,%f,%d" % (ITER, "insert_t", insert_t, rt.count))
+    print("%d,%s,%f,%d" % (ITER, "bulk_load_t", bulk_t, bt.count))
+    print("%d,%s,%f,%d" % (ITER, "load_mmap_t", load_t, lt.count))
+    print("%d,%s,%f,%d" % (ITER, "load_copy_t", copy_t, ct.count))
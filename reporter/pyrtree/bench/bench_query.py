@@ -0,0 +1,59 @@
+# Compares point and rect queries through the cursor with the stack based
+# query_point_ids and query_rect_ids, on a bulk loaded tree, and the batched
+# query_points (needs numpy).
+# Run from this directory: TEST_ITER=100000 python bench_query.py
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rect import Rect
+from pyrtree.rtree import RTree
+
+import os
+import random
+import time
+
+ITER=100000
+if "TEST_ITER" in os.environ:
+    ITER=int(os.getenv("TEST_ITER"))
+QUERIES=10000
+
+def timed(label, f, queries):
+    t = time.perf_counter()
+    found = 0
+    for q in queries:
+        found += len(f(q))
+    dt = time.perf_counter() - t
+    # query, total time, time per query in microseconds, leaves found
+    print("%s,%f,%f,%d" % (label, dt, dt / len(queries) * 1e6, found))
+
+if __name__ == "__main__":
+    random.seed(0)
+    items = []
+    for v in range(ITER):
+        x, y = random.uniform(0.0, 10.0), random.uniform(0.0, 10.0)
+        items.append((v, Rect(x, y, x + 0.05, y + 0.05)))
+    tree = RTree.bulk_load(items)
+
+    points = [ (random.uniform(0.0, 10.0), random.uniform(0.0, 10.0)) for i in range(QUERIES) ]
+    rects = [ Rect(x, y, x + 0.1, y + 0.1) for x, y in points ]
+
+    timed("cursor_point", lambda p: [ n for n in tree.query_point(p) if n.is_leaf() ], points)
+    timed("query_point_ids", tree.query_point_ids, points)
+    timed("cursor_rect", lambda r: [ n for n in tree.query_rect(r) if n.is_leaf() ], rects)
+    timed("query_rect_ids", tree.query_rect_ids, rects)
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None:
+        xs = np.array([ p[0] for p in points ])
+        ys = np.array([ p[1] for p in points ])
+        t = time.perf_counter()
+        offsets, leaves = tree.query_points(xs, ys)
+        dt = time.perf_counter() - t
+        print("query_points,%f,%f,%d" % (dt, dt / len(points) * 1e6, len(leaves)))
@@ -6,9 +6,18 @@ MAX_KMEANS=5
 import math, random, sys
 import time
 import array
+import mmap as _mmap
+import struct
 
 from .rect import Rect, union_all, NullRect
 
+# save/load file layout: the header, then the rect pool, node pool and leaf
+# table, each starting on an 8 byte boundary. Everything is in native byte
+# order; the itemsizes catch files from a platform with a different 'L'.
+FILE_MAGIC = b"PYRTREE\0"
+FILE_VERSION = 1
+_HEADER = struct.Struct("=8sIBBBxQQ")
+
 class RTree(object):
     def __init__(self):
         self.count = 0
@@ -33,6 +42,8 @@ class RTree(object):
         self.rect_pool = array.array('d')
         self.node_pool = array.array('L')
         self.leaf_pool = [] # leaf objects. 
+        self._child_cache = None # see _child_index
+        self._mmap = None # the mapped file of a tree opened with load
 
         self.cursor = _NodeCursor.create(self, NullRect)
 
@@ -41,10 +52,255 @@ class RTree(object):
             self.rect_pool.extend([0,0,0,0] * idx)
             self.node_pool.extend([0,0] * idx)
 
+    @classmethod
+    def bulk_load(cls, items, maxchildren=MAXCHILDREN):
+        """ Build a packed tree from (obj, rect) pairs with Sort-Tile-Recursive.
+
+        Nodes are written straight into the pools level by level, so the
+        tree is deterministic for the same input and every node but the
+        last of each slice is full. It can still be inserted into. """
+        tree = cls()
+        rp = tree.rect_pool
+        npool = tree.node_pool
+
+        level = []
+        for o, r in items:
+            x, y, xx, yy = r.coords()
+            # Leaves are marked by storing x swapped, like create_leaf.
+            rp.extend((xx, y, x, yy))
+            npool.extend((0, tree.leaf_count))
+            tree.leaf_pool.append(o)
+            tree.leaf_count += 1
+            level.append((tree.count, x, y, xx, yy))
+            tree.count += 1
+
+        while len(level) > maxchildren:
+            parents = []
+            for group in _str_groups(level, maxchildren):
+                x, y, xx, yy = _link_siblings(npool, group)
+                rp.extend((x, y, xx, yy))
+                npool.extend((0, group[0][0]))
+                parents.append((tree.count, x, y, xx, yy))
+                tree.count += 1
+            level = parents
+
+        if level:
+            rp[0], rp[1], rp[2], rp[3] = _link_siblings(npool, level)
+            npool[1] = level[0][0]
+        tree.cursor._become(0)
+        return tree
+
+    def save(self, path):
+        """ Write the tree to path for load. Leaf objects are stored in a
+        table of 64 bit ints, so they must be ints (e.g. indexes into a list
+        kept elsewhere). """
+        try:
+            leaves = array.array('q', self.leaf_pool)
+        except TypeError:
+            raise TypeError("only trees with int leaf objects can be saved")
+        header = _HEADER.pack(FILE_MAGIC, FILE_VERSION,
+                              self.rect_pool.itemsize, self.node_pool.itemsize,
+                              leaves.itemsize, self.count, self.leaf_count)
+        with open(path, "wb") as f:
+            f.write(header)
+            # The pools can be longer than count, see _ensure_pool.
+            for part in (self.rect_pool[:4 * self.count],
+                         self.node_pool[:2 * self.count], leaves):
+                f.write(b"\0" * (-f.tell() % 8))
+                f.write(part.tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Open a tree written by save.
+
+        With mmap the pools and leaf table are read-only memoryviews of the
+        mapped file, so nothing is parsed or copied and pages are only read
+        when queries touch them; such a tree can't be inserted into. Without
+        it they are read into arrays and the tree works like a built one. """
+        with open(path, "rb") as f:
+            if mmap:
+                buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        if len(buf) < _HEADER.size:
+            raise ValueError("%s is not a saved RTree" % path)
+        magic, version, rsize, nsize, lsize, count, leaf_count = \
+            _HEADER.unpack_from(buf)
+        if magic != FILE_MAGIC:
+            raise ValueError("%s is not a saved RTree" % path)
+        if version != FILE_VERSION:
+            raise ValueError("%s has RTree file version %d, not %d"
+                             % (path, version, FILE_VERSION))
+        if (rsize, nsize, lsize) != (array.array('d').itemsize,
+                                     array.array('L').itemsize,
+                                     array.array('q').itemsize):
+            raise ValueError("%s was saved on a platform with other item sizes"
+                             % path)
+
+        view = memoryview(buf)
+        parts = []
+        offset = _HEADER.size
+        for code, size, n in (('d', rsize, 4 * count), ('L', nsize, 2 * count),
+                              ('q', lsize, leaf_count)):
+            offset += -offset % 8
+            part = view[offset:offset + size * n]
+            if len(part) != size * n:
+                raise ValueError("%s is truncated" % path)
+            if mmap:
+                parts.append(part.cast(code))
+            else:
+                parts.append(array.array(code))
+                parts[-1].frombytes(part)
+            offset += size * n
+
+        tree = cls()
+        tree.count = count
+        tree.leaf_count = leaf_count
+        tree.rect_pool, tree.node_pool, leaves = parts
+        tree.leaf_pool = leaves if mmap else leaves.tolist()
+        if mmap:
+            tree._mmap = buf
+        tree.cursor = _NodeCursor(tree, 0, NullRect, 0, 0)
+        tree.cursor._become(0)
+        return tree
+
     def insert(self,o, orect):
         self.cursor.insert(o,orect)
         assert(self.cursor.index == 0)
 
+    def query_point_ids(self, p):
+        """ Return the leaf_pool indexes of leaves whose rects contain p.
+
+        Walks the pools with an explicit stack instead of cursors, so no
+        nodes or rects are created. Results are in no particular order. """
+        x, y = p
+        rp = self.rect_pool
+        npool = self.node_pool
+        found = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            r = 4 * i
+            x0 = rp[r]
+            x1 = rp[r + 2]
+            if x0 > x1:
+                # Leaf, stored with x swapped.
+                if x1 <= x <= x0 and rp[r + 1] <= y <= rp[r + 3]:
+                    found.append(npool[2 * i + 1])
+            elif x0 <= x <= x1 and rp[r + 1] <= y <= rp[r + 3]:
+                c = npool[2 * i + 1]
+                while c:
+                    stack.append(c)
+                    c = npool[2 * c]
+        return found
+
+    def query_rect_ids(self, q):
+        """ Return the leaf_pool indexes of leaves whose rects intersect q,
+        with the same area > 0 test as Rect.does_intersect. """
+        qx, qy, qxx, qyy = q.coords()
+        rp = self.rect_pool
+        npool = self.node_pool
+        found = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            r = 4 * i
+            x0 = rp[r]
+            x1 = rp[r + 2]
+            leaf = x0 > x1
+            if leaf:
+                x0, x1 = x1, x0
+            if (max(x0, qx) < min(x1, qxx)
+                    and max(rp[r + 1], qy) < min(rp[r + 3], qyy)):
+                if leaf:
+                    found.append(npool[2 * i + 1])
+                else:
+                    c = npool[2 * i + 1]
+                    while c:
+                        stack.append(c)
+                        c = npool[2 * c]
+        return found
+
+    def query_points(self, xs, ys):
+        """ Batched query_point_ids over arrays of coordinates.
+
+        Returns (offsets, leaves) numpy arrays in CSR form: the leaf_pool
+        indexes found for point i are leaves[offsets[i]:offsets[i + 1]].
+        The tree is walked one level at a time for every point still
+        inside a node, with the bbox tests vectorized per level. NaN
+        coordinates find nothing. Needs numpy, which is imported here so
+        the rest of the module doesn't depend on it. """
+        import numpy as np
+
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        starts, counts, children, payload = self._child_index()
+        # A view of the pool for this call only: the array can't be resized
+        # while it's exported, so no view may outlive the query.
+        rects = np.frombuffer(self.rect_pool, dtype=float).reshape(-1, 4)
+
+        # Seeded with empty arrays so no points, or no hits, still concatenate
+        found_points = [np.zeros(0, dtype=np.intp)]
+        found_leaves = [np.zeros(0, dtype=np.intp)]
+        points = np.arange(len(xs))
+        nodes = np.zeros(len(xs), dtype=np.intp)
+        while len(points):
+            r = rects[nodes]
+            leaf = r[:, 0] > r[:, 2]
+            lo = np.where(leaf, r[:, 2], r[:, 0])
+            hi = np.where(leaf, r[:, 0], r[:, 2])
+            px = xs[points]
+            py = ys[points]
+            hit = (lo <= px) & (px <= hi) & (r[:, 1] <= py) & (py <= r[:, 3])
+
+            leaf_hit = hit & leaf
+            found_points.append(points[leaf_hit])
+            found_leaves.append(payload[nodes[leaf_hit]])
+
+            inner = hit & ~leaf
+            points = points[inner]
+            nodes = nodes[inner]
+            n = counts[nodes]
+            first = np.repeat(np.cumsum(n) - n, n)
+            points = np.repeat(points, n)
+            nodes = children[np.repeat(starts[nodes], n) + np.arange(n.sum()) - first]
+        del rects
+
+        found_points = np.concatenate(found_points)
+        order = np.argsort(found_points, kind="stable")
+        offsets = np.zeros(len(xs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(found_points, minlength=len(xs)), out=offsets[1:])
+        leaves = np.concatenate(found_leaves)[order]
+        return offsets, leaves
+
+    def _child_index(self):
+        """ Children of every node as numpy arrays (starts, counts,
+        children), plus each node's first_child, which for leaves is its
+        leaf_pool index. Built once per tree size; every insert adds a
+        node, so a changed count means a changed tree. """
+        import numpy as np
+
+        cached = self._child_cache
+        if cached is not None and cached[0] == self.count:
+            return cached[1]
+        npool = self.node_pool
+        starts = np.zeros(self.count, dtype=np.intp)
+        counts = np.zeros(self.count, dtype=np.intp)
+        children = []
+        for i in range(self.count):
+            if self.rect_pool[4 * i] > self.rect_pool[4 * i + 2]:
+                continue
+            starts[i] = len(children)
+            c = npool[2 * i + 1]
+            while c:
+                children.append(c)
+                c = npool[2 * c]
+            counts[i] = len(children) - starts[i]
+        payload = np.array(npool[1:2 * self.count:2], dtype=np.intp)
+        index = (starts, counts, np.array(children, dtype=np.intp), payload)
+        self._child_cache = (self.count, index)
+        return index
+
     def query_rect(self, r):
         for x in self.cursor.query_rect(r): yield x
     def query_point(self, p):
@@ -52,6 +308,25 @@ class RTree(object):
     def walk(self,pred):
         return self.cursor.walk(pred)
 
+def _str_groups(entries, m):
+    """ Tile (index, x, y, xx, yy) entries into groups of at most m: sort by
+    center x, cut into vertical slices, then sort each slice by center y. """
+    pages = -(-len(entries) // m)
+    per_slice = m * int(math.ceil(math.sqrt(pages)))
+    entries = sorted(entries, key=lambda e: e[1] + e[3])
+    for s in range(0, len(entries), per_slice):
+        tile = sorted(entries[s:s + per_slice], key=lambda e: e[2] + e[4])
+        for g in range(0, len(tile), m):
+            yield tile[g:g + m]
+
+def _link_siblings(npool, group):
+    """ Chain a group of entries as siblings and return their union bbox. """
+    for (idx, _, _, _, _), (nxt, _, _, _, _) in zip(group, group[1:]):
+        npool[2 * idx] = nxt
+    npool[2 * group[-1][0]] = 0
+    return (min(e[1] for e in group), min(e[2] for e in group),
+            max(e[3] for e in group), max(e[4] for e in group))
+
 class _NodeCursor(object):
     @classmethod
     def create(cls, rooto, rect):
@@ -237,7 +512,7 @@ class _NodeCursor(object):
             return
 
 
-        t = time.clock()
+        t = time.perf_counter()
         
         cur_score = -10
 
@@ -246,13 +521,13 @@ class _NodeCursor(object):
         memo = {}
 
         clusterings = [ k_means_cluster(self.root,k,s_children) for k in range(2,MAX_KMEANS) ]
-        score,bestcluster = max( [ (silhouette_coeff(c,memo),c) for c in clusterings ])
+        score,bestcluster = max( [ (silhouette_coeff(c,memo),c) for c in clusterings ], key=lambda sc: sc[0])
 
         nodes = [ _NodeCursor.create_with_children(c,self.root) for c in bestcluster if len(c) > 0]
 
         self._set_children(nodes)
         
-        dur = (time.clock() - t)
+        dur = (time.perf_counter() - t)
         c = float(self.root.stats["overflow_f"]) 
         oa = self.root.stats["avg_overflow_t_f"]
         self.root.stats["avg_overflow_t_f"] = (dur / (c + 1.0)) + (c * oa / (c + 1.0))
@@ -369,7 +644,7 @@ def closest(centroids, node):
 
 
 def k_means_cluster(root, k, nodes):
-    t = time.clock()
+    t = time.perf_counter()
     if len(nodes) <= k: return [ [n] for n in nodes ]
     
     ns = list(nodes)
@@ -408,7 +683,7 @@ def k_means_cluster(root, k, nodes):
         new_cluster_centers = [ center_of_gravity(c) for c in clusters ]
         if new_cluster_centers == cluster_centers : 
             root.stats["avg_kmeans_iter_f"] = float(root.stats["sum_kmeans_iter_f"] / root.stats["count_kmeans_iter_f"])
-            root.stats["longest_kmeans"] = max(root.stats["longest_kmeans"], (time.clock() - t))
+            root.stats["longest_kmeans"] = max(root.stats["longest_kmeans"], (time.perf_counter() - t))
             return clusters
         else: cluster_centers = new_cluster_centers
         
@@ -5,9 +5,12 @@ if __name__ == "__main__":
     sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
 
 from pyrtree import Rect, RTree
+from pyrtree.rect import NullRect
 #from pyrtree.rect import *
 
 import collections
+import os
+import tempfile
 import unittest as ut
 import random, math
 from testutil import *
@@ -150,6 +153,13 @@ class RectangleTests(ut.TestCase):
             
 
 class RTreeTest(ut.TestCase):
+    def build(self, xs):
+        tree = RTree()
+        for x in xs:
+            tree.insert(x,x.rect)
+            self.invariants(tree)
+        return tree
+
     def testCons(self):
         n = RTree()
 
@@ -190,10 +200,7 @@ class RTreeTest(ut.TestCase):
     def testContainer(self):
         """ Test container-like behaviour. """
         xs = [ TstO(r) for r in take(100,G.rect, 0.1) ]
-        tree = RTree()
-        for x in xs: 
-            tree.insert(x,x.rect)
-            self.invariants(tree)
+        tree = self.build(xs)
 
         ws = [ x.leaf_obj() for x in tree.walk(lambda x,y: True) if x.is_leaf() ]
         self.invariants(tree)
@@ -207,10 +214,7 @@ class RTreeTest(ut.TestCase):
     def testDegenerateContainer(self):
         """ Tests that an r-tree still works like a container even with highly overlapping rects. """
         xs = [ TstO(r) for r in take(1000,G.rect, 20.0) ]
-        tree = RTree()
-        for x in xs: 
-            tree.insert(x,x.rect)
-            self.invariants(tree)
+        tree = self.build(xs)
 
         ws = [ x.leaf_obj() for x in tree.walk(lambda x,y: True) if x.is_leaf() ]
         for x in xs: self.assertTrue(x in ws)
@@ -227,10 +231,7 @@ class RTreeTest(ut.TestCase):
 
     def testPointQuery(self):
         xs = [ TstO(r) for r in take(1000,G.rect, 0.01) ]
-        tree = RTree()
-        for x in xs:
-            tree.insert(x,x.rect)
-            self.invariants(tree)
+        tree = self.build(xs)
         
         for x in xs:
             qp = G.pointInside(x.rect)
@@ -243,10 +244,7 @@ class RTreeTest(ut.TestCase):
 
     def testRectQuery(self):
         xs = [ TstO(r) for r in take(1000, G.rect, 0.01) ]
-        rt = RTree()
-        for x in xs: 
-            rt.insert(x,x.rect)
-            self.invariants(rt)
+        rt = self.build(xs)
 
         for x in xs:
             qrect = G.intersectingWith(x.rect)
@@ -262,5 +260,134 @@ class RTreeTest(ut.TestCase):
             self.assertFalse(x in rres)
 
 
+    def testQueryIds(self):
+        """ The stack based queries find the same leaves as the cursor. """
+        xs = [ TstO(r) for r in take(1000, G.rect, 0.5) ]
+        tree = self.build(xs)
+        def ids(nodes): return sorted(n.first_child for n in nodes if n.is_leaf())
+        for x in xs[:200]:
+            for p in (G.pointInside(x.rect), G.pointOutside(x.rect)):
+                self.assertEqual(sorted(tree.query_point_ids(p)),
+                                 ids(tree.query_point(p)))
+            for q in (G.intersectingWith(x.rect), G.disjointWith(x.rect)):
+                self.assertEqual(sorted(tree.query_rect_ids(q)),
+                                 ids(tree.query_rect(q)))
+        found = [ tree.leaf_pool[i] for i in tree.query_point_ids(G.pointInside(xs[0].rect)) ]
+        self.assertTrue(xs[0] in found)
+
+
+    def testQueryPoints(self):
+        """ The batched query finds the same leaves as one point at a time. """
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        xs = [ TstO(r) for r in take(1000, G.rect, 0.5) ]
+        tree = self.build(xs)
+        ps = [ G.pointInside(x.rect) for x in xs[:200] ]
+        ps += [ G.pointOutside(x.rect) for x in xs[:200] ]
+        ps.append((float("nan"), 1.0))
+        offsets, leaves = tree.query_points([p[0] for p in ps], [p[1] for p in ps])
+        self.assertEqual(len(offsets), len(ps) + 1)
+        for i, p in enumerate(ps):
+            self.assertEqual(sorted(leaves[offsets[i]:offsets[i + 1]].tolist()),
+                             sorted(tree.query_point_ids(p)))
+
+    def testQueryPointsNone(self):
+        """ No points, or no hits, give empty arrays. """
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        tree = self.build([ TstO(Rect(0.0, 0.0, 1.0, 1.0)) ])
+        for xs, ys in [([], []), ([5.0, float("nan")], [5.0, 1.0])]:
+            offsets, leaves = tree.query_points(xs, ys)
+            self.assertEqual(offsets.tolist(), [0] * (len(xs) + 1))
+            self.assertEqual(leaves.tolist(), [])
+
+
+class BulkLoadTest(RTreeTest):
+    """ Runs the tree tests against bulk loaded trees. """
+    def build(self, xs):
+        tree = RTree.bulk_load((x, x.rect) for x in xs)
+        self.invariants(tree)
+        return tree
+
+    def testDeterministic(self):
+        xs = [ TstO(r) for r in take(1000, G.rect, 0.01) ]
+        a, b = self.build(xs), self.build(xs)
+        self.assertEqual(a.rect_pool, b.rect_pool)
+        self.assertEqual(a.node_pool, b.node_pool)
+
+    def testPacked(self):
+        xs = [ TstO(r) for r in take(1000, G.rect, 0.01) ]
+        tree = self.build(xs)
+        # 1000 leaves in 100 full nodes, then 10 nodes under the root
+        self.assertEqual(tree.count, 1 + 1000 + 100 + 10)
+
+    def testInsertAfter(self):
+        xs = [ TstO(r) for r in take(100, G.rect, 0.1) ]
+        tree = self.build(xs[:50])
+        for x in xs[50:]:
+            tree.insert(x, x.rect)
+            self.invariants(tree)
+        ws = [ x.leaf_obj() for x in tree.walk(lambda x,y: True) if x.is_leaf() ]
+        self.assertEqual(sorted(map(id, ws)), sorted(map(id, xs)))
+
+    def testEmpty(self):
+        tree = RTree.bulk_load([])
+        self.invariants(tree)
+        self.assertEqual(list(tree.query_point((1.0, 1.0))), [])
+
+
+class SaveLoadTest(ut.TestCase):
+    """ Trees written with save and opened with load. """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".rtree")
+        os.close(fd)
+        self.rects = list(take(1000, G.rect, 0.5))
+        self.tree = RTree.bulk_load(enumerate(self.rects))
+        self.tree.save(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testRoundTrip(self):
+        for mmap in (True, False):
+            tree = RTree.load(self.path, mmap=mmap)
+            self.assertEqual(tree.count, self.tree.count)
+            self.assertEqual(list(tree.leaf_pool), self.tree.leaf_pool)
+            for r in self.rects[:100]:
+                for p in (G.pointInside(r), G.pointOutside(r)):
+                    self.assertEqual(sorted(tree.query_point_ids(p)),
+                                     sorted(self.tree.query_point_ids(p)))
+                q = G.intersectingWith(r)
+                self.assertEqual(sorted(tree.query_rect_ids(q)),
+                                 sorted(self.tree.query_rect_ids(q)))
+                ws = [ n.leaf_obj() for n in tree.query_point(G.pointInside(r))
+                       if n.is_leaf() ]
+                self.assertTrue(self.rects.index(r) in ws)
+
+    def testInsertAfterLoad(self):
+        tree = RTree.load(self.path, mmap=False)
+        r = G.rect(0.5)
+        tree.insert(len(self.rects), r)
+        self.assertTrue(len(self.rects) in
+                        [ tree.leaf_pool[i] for i in tree.query_point_ids(G.pointInside(r)) ])
+
+    def testObjectLeaves(self):
+        tree = RTree.bulk_load((TstO(r), r) for r in self.rects[:10])
+        self.assertRaises(TypeError, tree.save, self.path)
+
+    def testBadFiles(self):
+        with open(self.path, "r+b") as f:
+            f.seek(8)
+            f.write(b"\xff")
+        self.assertRaises(ValueError, RTree.load, self.path)
+        with open(self.path, "wb") as f:
+            f.write(b"not a tree")
+        self.assertRaises(ValueError, RTree.load, self.path)
+
+
 if __name__ == '__main__':
     ut.main()
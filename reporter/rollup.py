@@ -0,0 +1,251 @@
+import logging
+import os
+from collections import Counter
+from datetime import time
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    and_,
+    func,
+    or_,
+)
+from sqlalchemy.dialects.postgresql import array_agg
+from sqlalchemy.exc import DBAPIError
+
+from .cache import split_param
+from .categories import get_category_index
+from .database import db_session as session
+from .database import engine
+from .geography import GEOGRAPHIES, get_geography
+from .models import Addresses, Calls, Categories, Issues
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_NAME = "daily_counts"
+
+metadata = MetaData()
+
+# Calls and issues counted per day, region and category. A NULL region_id counts
+# records outside every region and a NULL category counts records regardless of
+# category. at_midnight separates records created exactly at midnight, which
+# date range filters include on their end date.
+rollup_table = Table(
+    "reporter_daily_counts",
+    metadata,
+    Column("day", Date, nullable=False),
+    Column("at_midnight", Boolean, nullable=False),
+    Column("region_kind", String, nullable=False),
+    Column("region_id", String),
+    Column("category", String),
+    Column("count", Integer, nullable=False),
+    Index("reporter_daily_counts_kind_day_idx", "region_kind", "day"),
+)
+
+state_table = Table(
+    "reporter_rollup_state",
+    metadata,
+    Column("name", String, primary_key=True),
+    Column("high_water", DateTime),
+)
+
+
+def rollup_enabled():
+    return bool(os.getenv("DAILY_ROLLUP"))
+
+
+def _high_water():
+    marks = [
+        session.query(func.max(cls.updated_at)).scalar()
+        for cls in (Calls, Issues, Addresses)
+    ]
+    marks = [mark for mark in marks if mark is not None]
+    return max(marks) if marks else None
+
+
+def changed_days(since):
+    """Return the days with calls or issues updated, or re-addressed, after since"""
+    days = set()
+    for cls in (Calls, Issues):
+        query = (
+            session.query(func.date(cls.created_at))
+            .outerjoin(cls.address)
+            .filter(
+                cls.created_at.isnot(None),
+                or_(cls.updated_at > since, Addresses.updated_at > since),
+            )
+            .distinct()
+        )
+        days.update(day for day, in query)
+    return days
+
+
+def count_days(days=None):
+    """Count calls and issues into rollup rows for a set of days, or all of them"""
+    counts = Counter()
+    for cls in (Calls, Issues):
+        query = (
+            session.query(
+                cls.created_at, Addresses.lon, Addresses.lat, array_agg(Categories.id)
+            )
+            .outerjoin(cls.categories)
+            .outerjoin(cls.address)
+            .filter(cls.created_at.isnot(None))
+            .group_by(cls.id, Addresses.id)
+        )
+        if days is not None:
+            query = query.filter(func.date(cls.created_at).in_(days))
+        records = query.all()
+
+        for geog in GEOGRAPHIES:
+            geography = get_geography(geog)
+            regions = geography.assign(
+                [r.lon for r in records], [r.lat for r in records]
+            )
+            for (created_at, _, _, categories), idx in zip(records, regions.tolist()):
+                region = str(geography.regions[idx]) if idx >= 0 else None
+                key = (created_at.date(), created_at.time() == time(), geog, region)
+                counts[key + (None,)] += 1
+                for category in categories:
+                    if category is not None:
+                        counts[key + (category,)] += 1
+
+    ids = [key[-1] for key in counts if key[-1] is not None]
+    index = get_category_index(ids)
+    names = dict(zip(index.ids, index.names))
+    names[None] = None
+    keys = ("day", "at_midnight", "region_kind", "region_id", "category")
+    return [
+        dict(zip(keys, key[:-1] + (names[key[-1]],)), count=count)
+        for key, count in counts.items()
+    ]
+
+
+def run_rollup(full=False):
+    """Bring the daily counts up to date, returning the number of days recounted
+
+    Only days with calls, issues or addresses updated since the last run are
+    recounted unless full is set. Changes that don't touch updated_at, like
+    recategorizing a call or moving its created_at to another day, or new
+    boundary files, need a full rebuild.
+    """
+    metadata.create_all(engine)
+    high_water = _high_water()
+    since = None
+    if not full:
+        since = (
+            session.query(state_table.c.high_water)
+            .filter(state_table.c.name == ROLLUP_NAME)
+            .scalar()
+        )
+
+    if since is None:
+        days = None
+        session.execute(rollup_table.delete())
+    else:
+        days = changed_days(since)
+        if days:
+            session.execute(rollup_table.delete().where(rollup_table.c.day.in_(days)))
+
+    if days is None or days:
+        rows = count_days(days)
+        if rows:
+            session.execute(rollup_table.insert(), rows)
+    session.execute(state_table.delete().where(state_table.c.name == ROLLUP_NAME))
+    session.execute(
+        state_table.insert(), {"name": ROLLUP_NAME, "high_water": high_water}
+    )
+    session.commit()
+
+    if days is None:
+        days = session.query(rollup_table.c.day).distinct().all()
+    logger.info("Recounted %d days up to %s", len(days), high_water)
+    return len(days)
+
+
+def rollup_counts(geography, start_date, end_date, categories):
+    """Answer a geo aggregation from the daily counts instead of the raw tables
+
+    Returns AggregationResult fields and the day from which the rest of the date
+    range has to be counted live and added, or None for that day when the
+    rollup covers the whole range. Only days before that of the latest update
+    seen by the last run are covered, so records added since are still counted.
+
+    Returns None when the rollup is disabled, hasn't been built or can't answer
+    the filter. More than one category can't be answered because records in
+    several of them would be counted repeatedly.
+    """
+    categories = split_param(categories)
+    if not rollup_enabled() or (categories and len(categories) > 1):
+        return None
+
+    filter_list = [
+        rollup_table.c.region_kind == geography.name,
+        rollup_table.c.day >= start_date,
+    ]
+    if categories:
+        filter_list.append(rollup_table.c.category == categories[0])
+    try:
+        state = (
+            session.query(state_table.c.high_water)
+            .filter(state_table.c.name == ROLLUP_NAME)
+            .first()
+        )
+        if state is None or state.high_water is None:
+            return None
+        live_from = state.high_water.date()
+        if start_date >= live_from:
+            return None
+        if end_date < live_from:
+            live_from = None
+            filter_list.append(
+                or_(
+                    rollup_table.c.day < end_date,
+                    and_(rollup_table.c.day == end_date, rollup_table.c.at_midnight),
+                )
+            )
+        else:
+            filter_list.append(rollup_table.c.day < live_from)
+        rows = (
+            session.query(
+                rollup_table.c.region_id,
+                rollup_table.c.category,
+                func.sum(rollup_table.c.count),
+            )
+            .filter(*filter_list)
+            .group_by(rollup_table.c.region_id, rollup_table.c.category)
+            .all()
+        )
+    except DBAPIError:
+        session.rollback()
+        logger.warning("Daily rollup unavailable, counting live", exc_info=True)
+        return None
+
+    index = {str(region): idx for idx, region in enumerate(geography.regions)}
+    totals = [0] * len(geography)
+    category_counts = [{} for _ in range(len(geography))]
+    unassigned = 0
+    for region_id, category, count in rows:
+        count = int(count)
+        idx = index.get(region_id)
+        if idx is not None and category is not None:
+            category_counts[idx][category] = count
+        # Totals are the NULL category rows, or the filtered category's rows
+        if categories or category is None:
+            if idx is None:
+                unassigned += count
+            else:
+                totals[idx] += count
+    counts = {
+        "totals": totals,
+        "category_counts": category_counts,
+        "unassigned": unassigned,
+    }
+    return counts, live_from
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy.dialects.postgresql import array_agg
+
+from .categories import CategoryIndex, get_category_index
+from .database import db_session as session
+from .geography import GEOGRAPHIES, get_geography
+from .models import Addresses, Calls, Categories, Issues
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+DEFAULT_DIR = "/tmp/reporter_snapshot"
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_enabled():
+    return os.getenv("REPORT_SOURCE", "live") == "snapshot"
+
+
+def _save(path, name, array):
+    tmp_path = os.path.join(path, name + ".tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, os.path.join(path, name + ".npy"))
+
+
+def export_snapshot(path=None):
+    """Write calls and issues as columns of .npy files with regions assigned
+
+    Each record keeps its created_at, zip, region index in every geography and a
+    row of a records x categories matrix, which is all the geo reports filter
+    and count by. meta.json is written last and names the categories, zips and
+    regions the columns refer to. Returns the number of records written.
+    """
+    path = path or os.getenv("SNAPSHOT_DIR", DEFAULT_DIR)
+    os.makedirs(path, exist_ok=True)
+
+    records = []
+    for cls in (Calls, Issues):
+        records.extend(
+            session.query(
+                cls.created_at,
+                Addresses.zip,
+                Addresses.lon,
+                Addresses.lat,
+                array_agg(Categories.id),
+            )
+            .outerjoin(cls.categories)
+            .outerjoin(cls.address)
+            .filter(cls.created_at.isnot(None))
+            .group_by(cls.id, Addresses.id)
+            .all()
+        )
+
+    zips = sorted({r.zip for r in records if r.zip is not None})
+    zip_idx = {z: idx for idx, z in enumerate(zips)}
+
+    lengths = [len(r[-1]) for r in records]
+    rows = np.repeat(np.arange(len(records)), lengths)
+    category_ids = np.array(
+        [-1 if c is None else c for r in records for c in r[-1]], dtype=np.int64
+    )
+    index = get_category_index(category_ids[category_ids >= 0])
+    columns = index.columns(category_ids)
+    categories = np.zeros((len(records), len(index)), dtype=bool)
+    categories[rows[columns >= 0], columns[columns >= 0]] = True
+
+    _save(
+        path,
+        "created_at",
+        np.array([r.created_at for r in records], dtype="datetime64[us]"),
+    )
+    _save(
+        path,
+        "zip",
+        np.array([zip_idx.get(r.zip, -1) for r in records], dtype=np.int32),
+    )
+    _save(path, "categories", categories)
+    regions = {}
+    for geog in GEOGRAPHIES:
+        geography = get_geography(geog)
+        assigned = geography.assign([r.lon for r in records], [r.lat for r in records])
+        _save(path, "region_" + geog, assigned.astype(np.int16))
+        regions[geog] = list(geography.regions)
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "created": datetime.now().isoformat(),
+        "records": len(records),
+        "categories": index.names,
+        "zips": zips,
+        "regions": regions,
+    }
+    tmp_path = os.path.join(path, "meta.json.tmp")
+    with open(tmp_path, "w") as mf:
+        json.dump(meta, mf)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+    return len(records)
+
+
+class Snapshot:
+    """Memory-mapped columns written by export_snapshot"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as mf:
+            self.meta = json.load(mf)
+        if self.meta["version"] != SNAPSHOT_VERSION:
+            raise ValueError(
+                "Snapshot version {} is not {}".format(
+                    self.meta["version"], SNAPSHOT_VERSION
+                )
+            )
+        self.path = path
+        self.category_names = self.meta["categories"]
+        self.category_index = CategoryIndex(enumerate(self.category_names))
+        self.zips = {z: idx for idx, z in enumerate(self.meta["zips"])}
+        self.created_at = self._load("created_at")
+        self.zip = self._load("zip")
+        self.categories = self._load("categories")
+        self.regions = {geog: self._load("region_" + geog) for geog in GEOGRAPHIES}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def _category_columns(self, categories):
+        """Return the matrix columns of the named categories, ignoring unknown ones"""
+        names = {name: idx for idx, name in enumerate(self.category_names)}
+        return [names[name] for name in categories if name in names]
+
+    def mask(self, start_date, end_date, categories, zip_codes):
+        """Return which records match the filters, the same way the live query does
+
+        categories and zip_codes are lists of names, or None not to filter by them.
+        """
+        mask = (self.created_at >= np.datetime64(start_date)) & (
+            self.created_at <= np.datetime64(end_date)
+        )
+        if categories is not None:
+            columns = self._category_columns(categories)
+            mask &= self.categories[:, columns].any(axis=1)
+        if zip_codes is not None:
+            zip_ids = [self.zips[z] for z in zip_codes if z in self.zips]
+            mask &= np.isin(self.zip, zip_ids)
+        return mask
+
+    def counts(self, geography, start_date, end_date, categories, zip_codes):
+        """Count the matching records per region into AggregationResult fields
+
+        Returns None if the snapshot was made with different boundaries.
+        """
+        if self.meta["regions"].get(geography.name) != list(geography.regions):
+            return None
+        mask = self.mask(start_date, end_date, categories, zip_codes)
+        regions = self.regions[geography.name]
+        assigned = mask & (regions >= 0)
+        assigned_regions = regions[assigned]
+        totals = np.bincount(assigned_regions, minlength=len(geography))
+
+        # Like the live query, only the filtered categories are counted
+        if categories is None:
+            columns = range(len(self.category_names))
+        else:
+            columns = self._category_columns(categories)
+        matrix = np.zeros((len(geography), len(self.category_names)), dtype=np.int64)
+        for column in columns:
+            matrix[:, column] = np.bincount(
+                assigned_regions,
+                weights=self.categories[assigned, column],
+                minlength=len(geography),
+            )
+        return {
+            "totals": totals.tolist(),
+            "category_counts": self.category_index.region_dicts(matrix),
+            "unassigned": int(mask.sum() - assigned.sum()),
+        }
+
+
+def get_snapshot():
+    """Return the process-wide Snapshot in snapshot mode, loading it once
+
+    Returns None when REPORT_SOURCE isn't "snapshot" or the snapshot in
+    SNAPSHOT_DIR can't be read, in which case reports query the database.
+    """
+    global _snapshot
+    if not snapshot_enabled():
+        return None
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                try:
+                    _snapshot = Snapshot(os.getenv("SNAPSHOT_DIR", DEFAULT_DIR))
+                except (OSError, ValueError, KeyError):
+                    logger.warning(
+                        "Snapshot unavailable, querying the database", exc_info=True
+                    )
+                    _snapshot = False
+    return _snapshot or None
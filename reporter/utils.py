@@ -1,49 +1,103 @@
-import json
-import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 
-from flask import g
-from shapely.geometry import Point, shape
-from sqlalchemy import union_all
-from sqlalchemy.dialects.postgresql import array_agg
+from sqlalchemy import distinct, func, literal, tuple_, union_all
+from sqlalchemy.orm import aliased
 
 from .database import db_session as session
-from .models import Addresses, Calls, Categories, Issues
-from .pyrtree import Rect, RTree
-
-
-def zip_rtree():
-    current_dir = os.path.dirname(__file__)
-    geo_path = os.path.join(current_dir, "static", "js", "chi_zips.geojson")
-    with open(geo_path, "r") as gf:
-        chi_zips = json.load(gf)
-    tree = RTree()
-    for i, a in enumerate(chi_zips["features"]):
-        shp = shape(a["geometry"])
-        tree.insert({"idx": i, "shape": shp}, Rect(*shp.bounds))
-    return chi_zips, tree
-
-
-def ward_rtree():
-    current_dir = os.path.dirname(__file__)
-    geo_path = os.path.join(current_dir, "static", "js", "chi_wards.geojson")
-    with open(geo_path, "r") as gf:
-        chi_wards = json.load(gf)
-    tree = RTree()
-    for i, a in enumerate(chi_wards["features"]):
-        shp = shape(a["geometry"])
-        tree.insert(
-            {"idx": i, "shape": shp, "ward": a["properties"]["ward"]}, Rect(*shp.bounds)
-        )
-    return chi_wards, tree
-
-
-def load_rtree(geog):
-    geog_tree = f"{geog}_tree"
-    geog_func = zip_rtree if geog == "zips" else ward_rtree
-    if geog_tree not in g:
-        setattr(g, geog_tree, geog_func())
-    return getattr(g, geog_tree)
+from .export import (
+    CSV_COLS,
+    EVICTION_COLS,
+    USER_PREFIXES,
+    category_names,
+    record_columns,
+)
+from .models import Addresses, Calls, Categories, EvictionRecords, Issues, User
+
+# Rows fetched per round trip and turned into CSV rows at a time by exports
+EXPORT_BATCH_SIZE = 1000
+
+
+def iter_batches(query, batch_size=EXPORT_BATCH_SIZE):
+    """Yield lists of a query's results, fetching batch_size rows at a time"""
+    batch = []
+    for row in query.yield_per(batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_concurrently(*functions):
+    """Call each function in a thread of its own, returning their results in order
+
+    Each thread queries through its own scoped session, and so its own pooled
+    connection, which is removed when the function returns.
+    """
+    with ThreadPoolExecutor(len(functions)) as pool:
+        return list(pool.map(_in_own_session, functions))
+
+
+def _in_own_session(function):
+    try:
+        return function()
+    finally:
+        session.remove()
+
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_in_thread(make_iterable, maxsize=2):
+    """Yield the items of make_iterable() as a thread of its own produces them
+
+    The thread has its own scoped session like run_concurrently, and keeps at
+    most maxsize items ahead of the consumer. Errors are raised in the consumer,
+    and closing the generator early stops the thread.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in make_iterable():
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(_Failed(e))
+        finally:
+            session.remove()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 def handle_dates(start_date, end_date):
@@ -59,53 +113,111 @@ def handle_dates(start_date, end_date):
     return start_date, end_date
 
 
-def call_issue_geog_query(cls, start_date, end_date, categories, zip_codes):
+def point_counts_query(cls, start_date, end_date, categories, zip_codes):
+    """Count matching calls or issues per address, and per address and category
+
+    Rows with total set hold the number of records at an address. The others
+    hold how many of those have each category_id, with None for records without
+    any. When filtering by categories only those categories are counted.
+    """
     filter_list = [cls.created_at >= start_date, cls.created_at <= end_date]
     if categories:
         filter_list.append(Categories.name.in_(categories.split(",")))
     if zip_codes:
         filter_list.append(Addresses.zip.in_(zip_codes.split(",")))
 
+    point = (Addresses.id, Addresses.lat, Addresses.lon)
     return (
         session.query(
-            array_agg(Categories.name).label("categories"),
-            cls.id.label("id"),
-            cls.created_at.label("created_at"),
+            Addresses.id.label("address_id"),
             Addresses.lat.label("lat"),
             Addresses.lon.label("lon"),
+            Categories.id.label("category_id"),
+            (func.grouping(Categories.id) == 1).label("total"),
+            func.count(distinct(cls.id)).label("count"),
         )
-        .outerjoin(cls.categories, Addresses)
+        .select_from(cls)
+        .outerjoin(cls.categories)
+        .outerjoin(cls.address)
         .filter(*filter_list)
-        .order_by(cls.created_at.desc())
-        .group_by(cls.id, cls.created_at, Addresses)
-        .distinct(cls.id, cls.created_at)
+        .group_by(func.grouping_sets(tuple_(*point), tuple_(*point, Categories.id)))
+    )
+
+
+def point_counts(start_date, end_date, categories, zip_codes):
+    """Return point_counts_query for calls and for issues as subqueries"""
+    return [
+        point_counts_query(cls, start_date, end_date, categories, zip_codes).subquery()
+        for cls in (Calls, Issues)
+    ]
+
+
+def union_points(tables):
+    """Return the subqueries of point_counts as one"""
+    return union_all(*[table.select() for table in tables]).alias("points")
+
+
+def record_query(cls, cols=CSV_COLS):
+    """Select cols for Calls or Issues as plain rows, joining what they need"""
+    users = {prefix: aliased(User) for prefix in USER_PREFIXES if hasattr(cls, prefix)}
+    names = category_names(cls)
+    query = (
+        session.query(*record_columns(cls, users, names, cols))
+        .select_from(cls)
+        .outerjoin(cls.address)
+        .outerjoin(names, names.c.id == cls.id)
     )
+    for prefix, user in users.items():
+        query = query.outerjoin(user, getattr(cls, prefix))
+    return query
 
 
-def handle_geog_filter(request, start_date, end_date):
-    categories = request.args.get("categories")
-    zip_codes = request.args.get("zip_codes")
-    geog = request.args.get("geog", "wards")
-
-    combined_query = union_all(
-        call_issue_geog_query(Calls, start_date, end_date, categories, zip_codes),
-        call_issue_geog_query(Issues, start_date, end_date, categories, zip_codes),
-    ).alias("call_issues")
-
-    chi_areas, tree = load_rtree(geog)
-
-    for p in session.query(combined_query):
-        if p.lon is None or p.lat is None:
-            continue
-        for r in tree.query_point((p.lon, p.lat)):
-            if not r.leaf_obj():
-                continue
-            shp = r.leaf_obj()
-            pt = Point(p.lon, p.lat)
-            if pt.within(shp["shape"]):
-                props = chi_areas["features"][shp["idx"]]["properties"]
-                if "ci_count" not in props:
-                    chi_areas["features"][shp["idx"]]["properties"]["ci_count"] = 0
-                chi_areas["features"][shp["idx"]]["properties"]["ci_count"] += 1
-
-    return chi_areas
+def detail_query(cls, start_date, end_date, categories, zip_codes, cols=CSV_COLS):
+    """Select cols for Calls or Issues as plain rows, ordered by created_at"""
+    query = record_query(cls, cols)
+    filter_list = [cls.created_at >= start_date, cls.created_at <= end_date]
+    if categories:
+        filter_list.append(
+            cls.categories.any(Categories.name.in_(categories.split(",")))
+        )
+    if zip_codes:
+        filter_list.append(Addresses.zip.in_(zip_codes.split(",")))
+    return query.filter(*filter_list).order_by(cls.created_at.asc())
+
+
+def eviction_query(start_date, end_date):
+    """Select eviction records as flat rows of EVICTION_COLS then their latest call
+
+    The latest call is picked with DISTINCT ON in the same statement, only among
+    the calls of records in the date range. For records without calls its
+    CSV_COLS are NULL, except call_issue which is always "call".
+    """
+    date_filter = [
+        EvictionRecords.created_at >= start_date,
+        EvictionRecords.created_at <= end_date,
+    ]
+    records = session.query(EvictionRecords.id).filter(*date_filter)
+    latest_call = (
+        record_query(Calls)
+        .filter(Calls.eviction_record_id.in_(records.subquery()))
+        .distinct(Calls.eviction_record_id)
+        .order_by(
+            Calls.eviction_record_id,
+            Calls.created_at.desc().nullslast(),
+            Calls.id.desc(),
+        )
+        .subquery()
+    )
+    call_columns = [latest_call.c[col].label(f"call_{col}") for col in CSV_COLS]
+    # Records without calls still say "call", as the export always has
+    call_columns[CSV_COLS.index("call_issue")] = literal("call").label(
+        "call_call_issue"
+    )
+    return (
+        session.query(
+            *record_columns(EvictionRecords, {}, None, EVICTION_COLS), *call_columns
+        )
+        .outerjoin(latest_call, latest_call.c.eviction_record_id == EvictionRecords.id)
+        .filter(*date_filter)
+        .order_by(EvictionRecords.created_at.asc())
+    )
@@ -1,17 +1,32 @@
-from collections import defaultdict
+import heapq
 from datetime import date
+from functools import partial
+from itertools import chain
+from operator import itemgetter
 
-from flask import Blueprint, jsonify, render_template, request, send_file
+from flask import Blueprint, jsonify, render_template, request
 from flask_login import login_required
-from shapely.geometry import Point
-from sqlalchemy import union_all
-from sqlalchemy.orm import aliased, contains_eager, subqueryload
 
+from .address_regions import (
+    address_regions_available,
+    address_regions_table,
+    resolve_regions,
+    stored_region_columns,
+    stored_region_join,
+)
+from .aggregation import aggregate, handle_geog_filter
 from .auth import admin_required
-from .database import db_session as session
-from .export import CSV_COLS, EVICTION_COLS, CsvExport, EvictionRecordRow, RecordRow
-from .models import Addresses, Calls, Categories, EvictionRecords, Issues, User
-from .utils import call_issue_geog_query, handle_dates, handle_geog_filter, load_rtree
+from .export import CSV_COLS, EVICTION_COLS, CsvExport
+from .geography import assign_workers, get_geography, parallel_rows
+from .models import Addresses, Calls, Issues
+from .utils import (
+    EXPORT_BATCH_SIZE,
+    detail_query,
+    eviction_query,
+    handle_dates,
+    iter_batches,
+    iter_in_thread,
+)
 
 views = Blueprint("views", __name__)
 
@@ -22,7 +37,9 @@ def filter_geo():
     start_date, end_date = handle_dates(
         request.args.get("start_date"), request.args.get("end_date")
     )
-    return jsonify(handle_geog_filter(request, start_date, end_date))
+    return jsonify(
+        handle_geog_filter(request, start_date, end_date).feature_collection()
+    )
 
 
 @views.route("/filter-csv")
@@ -31,7 +48,7 @@ def filter_csv():
     start_date, end_date = handle_dates(
         request.args.get("start_date"), request.args.get("end_date")
     )
-    chi_areas = handle_geog_filter(request, start_date, end_date)
+    result = handle_geog_filter(request, start_date, end_date)
 
     geog = request.args.get("geog", "wards")
     categories = request.args.get("categories")
@@ -44,18 +61,10 @@ def filter_csv():
     geog_name = geog[:-1]
     export = CsvExport(
         [geog_name, "ci_count", start_date_str, end_date_str, categories, geog],
-        [
-            [feat["properties"][geog_name], feat["properties"].get("ci_count", 0)]
-            for feat in chi_areas["features"]
-        ],
+        result.csv_rows(),
     )
 
-    return send_file(
-        export.write_rows(),
-        mimetype="text/csv",
-        as_attachment=True,
-        attachment_filename=filename,
-    )
+    return export.response(filename)
 
 
 @views.route("/detail-csv")
@@ -69,97 +78,69 @@ def detail_csv():
     in_chicago = request.args.get("outside_chicago") is None
     include_wards = request.args.get("include_wards") is not None
 
-    call_filter_list = []
-    issue_filter_list = []
-    if categories:
-        category_list = categories.split(",")
-        call_filter_list.append(
-            Calls.categories.any(Categories.name.in_(category_list))
-        )
-        issue_filter_list.append(
-            Issues.categories.any(Categories.name.in_(category_list))
-        )
-    if zip_codes:
-        zip_list = zip_codes.split(",")
-        call_filter_list.append(Addresses.zip.in_(zip_list))
-        issue_filter_list.append(Addresses.zip.in_(zip_list))
-
-    tenant_alias = aliased(User)
-    landlord_alias = aliased(User)
-    rep_alias = aliased(User)
-
-    call_query = (
-        session.query(Calls)
-        .outerjoin(Calls.address)
-        .outerjoin(tenant_alias, Calls.tenant)
-        .outerjoin(landlord_alias, Calls.landlord)
-        .outerjoin(rep_alias, Calls.rep)
-        .options(
-            subqueryload(Calls.categories),
-            contains_eager(Calls.address),
-            contains_eager(Calls.tenant, alias=tenant_alias),
-            contains_eager(Calls.landlord, alias=landlord_alias),
-            contains_eager(Calls.rep, alias=rep_alias),
-        )
-        .filter(
-            Calls.created_at >= start_date,
-            Calls.created_at <= end_date,
-            *call_filter_list,
-        )
-        .order_by(Calls.created_at.asc())
-    )
-
-    issue_query = (
-        session.query(Issues)
-        .outerjoin(Issues.address)
-        .outerjoin(tenant_alias, Issues.tenant)
-        .outerjoin(landlord_alias, Issues.landlord)
-        .options(
-            subqueryload(Issues.categories),
-            contains_eager(Issues.address),
-            contains_eager(Issues.tenant, alias=tenant_alias),
-            contains_eager(Issues.landlord, alias=landlord_alias),
-        )
-        .filter(
-            Issues.created_at >= start_date,
-            Issues.created_at <= end_date,
-            *issue_filter_list,
-        )
-        .order_by(Issues.created_at.asc())
-    )
-
-    calls = [RecordRow(c) for c in call_query]
-    issues = [RecordRow(i) for i in issue_query]
-    calls_issues = calls + issues
-
-    if in_chicago and include_wards:
-        chi_wards, tree = load_rtree("wards")
-
-        for record in calls_issues:
-            if record.lon is None or record.lat is None:
+    chi_wards = get_geography("wards") if in_chicago and include_wards else None
+    ward_col = CSV_COLS.index("ward")
+    lat_col = CSV_COLS.index("lat")
+    lon_col = CSV_COLS.index("lon")
+
+    stored_wards = chi_wards is not None and address_regions_available()
+    # Wards are assigned a batch at a time, so when they're assigned here rather
+    # than read back, batches are made big enough to be split across processes
+    batch_size = EXPORT_BATCH_SIZE
+    if chi_wards is not None and not stored_wards and assign_workers() >= 2:
+        batch_size = max(batch_size, parallel_rows())
+
+    def record_batches(cls):
+        query = detail_query(cls, start_date, end_date, categories, zip_codes)
+        if stored_wards:
+            query = query.add_columns(*stored_region_columns(chi_wards)).outerjoin(
+                address_regions_table,
+                stored_region_join(Addresses.id, Addresses.lat, Addresses.lon),
+            )
+        for batch in iter_batches(query, batch_size):
+            if chi_wards is None:
+                yield batch
                 continue
-            for r in tree.query_point((record.lon, record.lat)):
-                if not r.leaf_obj:
-                    continue
-                shp = r.leaf_obj()
-                if shp is None:
-                    continue
-                pt = Point(record.lon, record.lat)
-                if pt.within(shp["shape"]):
-                    record.ward = shp["ward"]
+            lons = [r[lon_col] for r in batch]
+            lats = [r[lat_col] for r in batch]
+            if stored_wards:
+                regions = resolve_regions(
+                    chi_wards,
+                    lons,
+                    lats,
+                    [r.stored_region for r in batch],
+                    [r.region_stored for r in batch],
+                )
+            else:
+                regions = chi_wards.assign(lons, lats)
+            rows = []
+            for row, idx in zip(batch, regions.tolist()):
+                row = list(row[: len(CSV_COLS)])
+                if idx >= 0:
+                    row[ward_col] = chi_wards.regions[idx]
+                rows.append(row)
+            yield rows
+
+    def record_rows(cls):
+        # Calls and issues are fetched and assigned wards in threads of their
+        # own, so both queries run at the same time on separate connections
+        batches = iter_in_thread(partial(record_batches, cls))
+        return chain.from_iterable(batches)
+
+    # Both queries are ordered by created_at, so merging keeps the export in order
+    calls_issues = heapq.merge(
+        record_rows(Calls),
+        record_rows(Issues),
+        key=itemgetter(CSV_COLS.index("created_at")),
+    )
 
     start_date_str = start_date.strftime("%Y-%m-%d")
     end_date_str = end_date.strftime("%Y-%m-%d")
 
     filename = "sa_export_detail_{}_{}.csv".format(start_date_str, end_date_str)
 
-    export = CsvExport(CSV_COLS, [r.as_list() for r in calls_issues])
-    return send_file(
-        export.write_rows(),
-        mimetype="text/csv",
-        as_attachment=True,
-        attachment_filename=filename,
-    )
+    export = CsvExport(CSV_COLS, calls_issues)
+    return export.response(filename)
 
 
 @views.route("/eviction-record-csv")
@@ -169,59 +150,19 @@ def eviction_record_detail_csv():
         request.args.get("start_date"), request.args.get("end_date")
     )
 
-    tenant_alias = aliased(User)
-    landlord_alias = aliased(User)
-    rep_alias = aliased(User)
-
-    record_query = (
-        session.query(EvictionRecords)
-        .outerjoin(EvictionRecords.calls)
-        .outerjoin(Calls.address)
-        .outerjoin(tenant_alias, Calls.tenant)
-        .outerjoin(landlord_alias, Calls.landlord)
-        .outerjoin(rep_alias, Calls.rep)
-        .options(
-            subqueryload(EvictionRecords.calls),
-            subqueryload(EvictionRecords.calls).joinedload(Calls.address),
-            subqueryload(EvictionRecords.calls).joinedload(Calls.tenant),
-            subqueryload(EvictionRecords.calls).joinedload(Calls.landlord),
-            subqueryload(EvictionRecords.calls).joinedload(Calls.rep),
-            subqueryload(EvictionRecords.calls).joinedload(Calls.categories),
-            contains_eager(EvictionRecords.calls).contains_eager(Calls.address),
-            contains_eager(EvictionRecords.calls).contains_eager(
-                Calls.tenant, alias=tenant_alias
-            ),
-            contains_eager(EvictionRecords.calls).contains_eager(
-                Calls.landlord, alias=landlord_alias
-            ),
-            contains_eager(EvictionRecords.calls).contains_eager(
-                Calls.rep, alias=rep_alias
-            ),
-        )
-        .filter(
-            EvictionRecords.created_at >= start_date,
-            EvictionRecords.created_at <= end_date,
-        )
-        .order_by(EvictionRecords.created_at.asc())
-        .all()
-    )
-    records = [EvictionRecordRow(r) for r in record_query]
+    def eviction_rows():
+        for batch in iter_batches(eviction_query(start_date, end_date)):
+            yield from batch
 
     start_date_str = start_date.strftime("%Y-%m-%d")
     end_date_str = end_date.strftime("%Y-%m-%d")
 
     filename = "sa_export_evictions_{}_{}.csv".format(start_date_str, end_date_str)
     export = CsvExport(
-        EVICTION_COLS + [f"call_{col}" for col in CSV_COLS],
-        [r.as_list() for r in records],
+        EVICTION_COLS + [f"call_{col}" for col in CSV_COLS], eviction_rows()
     )
 
-    return send_file(
-        export.write_rows(),
-        mimetype="text/csv",
-        as_attachment=True,
-        attachment_filename=filename,
-    )
+    return export.response(filename)
 
 
 @views.route("/")
@@ -238,33 +179,8 @@ def breakdown_wards():
     )
     categories = request.args.get("categories")
 
-    filter_list = []
-    if categories:
-        filter_list.append(Categories.name.in_(categories.split(",")))
-
-    combined_query = union_all(
-        call_issue_geog_query(Calls, start_date, end_date, categories, None),
-        call_issue_geog_query(Issues, start_date, end_date, categories, None),
-    ).alias("call_issues")
-
-    chi_wards, tree = load_rtree("wards")
-
-    ward_dict = {str(i): defaultdict(lambda: 0) for i in range(1, 51)}
-    for p in session.query(combined_query):
-        if p.lon is None or p.lat is None:
-            continue
-        for r in tree.query_point((p.lon, p.lat)):
-            if not r.leaf_obj():
-                continue
-            shp = r.leaf_obj()
-            pt = Point(p.lon, p.lat)
-            if pt.within(shp["shape"]):
-                ward = chi_wards["features"][shp["idx"]]["properties"]["ward"]
-                for c in p.categories:
-                    if c is not None:
-                        ward_dict[ward][c] += 1
-
-    return jsonify(ward_dict)
+    result = aggregate(start_date, end_date, categories, None, "wards")
+    return jsonify(result.region_categories())
 
 
 @views.route("/breakdown")
@@ -279,7 +195,7 @@ def print_view():
     start_date, end_date = handle_dates(
         request.args.get("start_date"), request.args.get("end_date")
     )
-    chi_areas = handle_geog_filter(request, start_date, end_date)
+    chi_areas = handle_geog_filter(request, start_date, end_date).feature_collection()
 
     # Handle report titles based on year and month
     if start_date.year == end_date.year:
@@ -0,0 +1,19 @@
+import argparse
+import logging
+
+from reporter.address_regions import backfill_address_regions
+from reporter.rollup import run_rollup
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update the address regions and daily counts reports use"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="redo everything instead of only what changed since the last run",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    backfill_address_regions(full=args.full)
+    run_rollup(full=args.full)
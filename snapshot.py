@@ -0,0 +1,13 @@
+import argparse
+
+from reporter.snapshot import export_snapshot
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the columns geo reports are counted from"
+    )
+    parser.add_argument(
+        "path", nargs="?", help="directory to write to, SNAPSHOT_DIR by default"
+    )
+    args = parser.parse_args()
+    print("Exported {} calls and issues".format(export_snapshot(args.path)))
@@ -0,0 +1,5 @@
+import os
+import unittest as ut
+
+# Tests that query the database are skipped unless the DB_* settings are present
+requires_db = ut.skipUnless(os.getenv("DB_NAME"), "DB_* settings are not configured")
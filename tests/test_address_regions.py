@@ -0,0 +1,62 @@
+import os
+import unittest as ut
+from datetime import date
+from unittest import mock
+
+from reporter import address_regions, aggregation, cache
+from reporter.geography import get_geography
+from reporter.models import Addresses
+from tests import requires_db
+
+
+@requires_db
+class AddressRegionsTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wards = get_geography("wards")
+        address_regions.backfill_address_regions(full=True)
+
+    def tearDown(self):
+        address_regions.session.remove()
+
+    def testStoredMatchesGeometry(self):
+        table = address_regions.address_regions_table
+        rows = (
+            address_regions.session.query(Addresses.lon, Addresses.lat, table.c.wards)
+            .join(table, table.c.address_id == Addresses.id)
+            .all()
+        )
+        regions = self.wards.assign([r.lon for r in rows], [r.lat for r in rows])
+        expected = [str(self.wards.regions[i]) if i >= 0 else None for i in regions]
+        self.assertEqual([r.wards for r in rows], expected)
+
+    def testIncremental(self):
+        self.assertEqual(address_regions.backfill_address_regions(), 0)
+
+    def testResolveUnknown(self):
+        """Points without a stored row are assigned with the region index"""
+        lons, lats = [-87.63, -87.63, None], [41.88, 41.88, None]
+        regions = address_regions.resolve_regions(
+            self.wards, lons, lats, [None, None, None], [False, True, False]
+        )
+        expected = self.wards.assign(lons[:1], lats[:1])[0]
+        self.assertEqual(regions.tolist(), [expected, -1, -1])
+
+    def testAggregateMatches(self):
+        args = (date(2000, 1, 1), date.today(), None, None, "wards")
+        resolve = mock.Mock(wraps=address_regions.resolve_regions)
+        results = []
+        for enabled in ("", "1"):
+            env = {"ADDRESS_REGIONS": enabled}
+            with mock.patch.dict(os.environ, env), mock.patch.object(
+                aggregation, "resolve_regions", resolve
+            ), mock.patch.object(cache, "_cache", False), mock.patch.object(
+                address_regions, "_available", None
+            ):
+                results.append(aggregation.aggregate(*args).to_dict())
+        self.assertEqual(resolve.call_count, 1)
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+    ut.main()
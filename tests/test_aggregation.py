@@ -0,0 +1,63 @@
+import unittest as ut
+from unittest import mock
+
+from reporter import aggregation, cache
+from reporter.models import Calls, Categories, Issues
+from reporter.utils import handle_dates
+from tests import requires_db
+
+
+@requires_db
+class AggregationTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dates = handle_dates("2000-01-01", None)
+
+    def tearDown(self):
+        aggregation.session.remove()
+
+    def testCountsEveryRecord(self):
+        with mock.patch.object(cache, "_cache", False):
+            result = aggregation.aggregate(*self.dates, None, None, "wards")
+        total = sum(
+            aggregation.session.query(cls)
+            .filter(cls.created_at >= self.dates[0], cls.created_at <= self.dates[1])
+            .count()
+            for cls in (Calls, Issues)
+        )
+        self.assertEqual(sum(result.totals) + result.unassigned, total)
+        self.assertEqual(len(result.csv_rows()), len(result.geography))
+        self.assertEqual(
+            list(result.region_categories()), list(result.geography.regions)
+        )
+
+    def testCategoryFilter(self):
+        """Filtering by one category counts each record with it exactly once"""
+        with mock.patch.object(cache, "_cache", False):
+            result = aggregation.aggregate(*self.dates, "Repairs", None, "wards")
+        total = sum(
+            aggregation.session.query(cls)
+            .filter(cls.created_at >= self.dates[0], cls.created_at <= self.dates[1])
+            .filter(cls.categories.any(Categories.name == "Repairs"))
+            .count()
+            for cls in (Calls, Issues)
+        )
+        self.assertEqual(sum(result.totals) + result.unassigned, total)
+        self.assertEqual(
+            [counts.get("Repairs", 0) for counts in result.category_counts],
+            result.totals,
+        )
+        self.assertLessEqual(set().union(*result.category_counts), {"Repairs"})
+
+    def testSharedThroughCache(self):
+        """A cached result renders the same as a freshly computed one"""
+        with mock.patch.object(cache, "_cache", cache.MemoryCache()):
+            first = aggregation.aggregate(*self.dates, None, None, "zips")
+            with mock.patch.object(aggregation, "count_records") as count:
+                second = aggregation.aggregate(*self.dates, None, None, "zips")
+        count.assert_not_called()
+        self.assertEqual(second.feature_collection(), first.feature_collection())
+
+
+if __name__ == "__main__":
+    ut.main()
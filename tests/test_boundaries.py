@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest as ut
+from unittest import mock
+
+import numpy as np
+
+from reporter import geography
+
+
+class CompiledBoundariesTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        for geog in geography.GEOGRAPHIES:
+            geography.compile_geography(geog, cls.tmp.name)
+        rng = np.random.RandomState(0)
+        cls.lons = rng.uniform(-87.95, -87.5, 20000)
+        cls.lats = rng.uniform(41.6, 42.05, 20000)
+        cls.lons[:10] = np.nan
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def testMatchesGeoJSON(self):
+        for geog, (_, region_key) in geography.GEOGRAPHIES.items():
+            for index_cls in geography.REGION_INDEXES.values():
+                with self.subTest(geog=geog, index=index_cls.__name__):
+                    expected = geography.Geography.from_geojson(
+                        geog, geography.geojson_path(geog), region_key, index_cls
+                    )
+                    compiled = geography.load_compiled(geog, index_cls, self.tmp.name)
+                    self.assertEqual(compiled.regions, expected.regions)
+                    self.assertEqual(
+                        compiled.assign(self.lons, self.lats).tolist(),
+                        expected.assign(self.lons, self.lats).tolist(),
+                    )
+                    self.assertEqual(
+                        [shp.wkb for shp in compiled.shapes],
+                        [shp.wkb for shp in expected.shapes],
+                    )
+                    self.assertEqual(
+                        compiled.feature_collection(), expected.feature_collection()
+                    )
+
+    def testStale(self):
+        """The GeoJSON isn't read on load, but its size and mtime are compared"""
+        with tempfile.TemporaryDirectory() as path:
+            source = os.path.join(path, "wards.geojson")
+            shutil.copy2(geography.geojson_path("wards"), source)
+            stat = os.stat(source)
+            with mock.patch.object(geography, "geojson_path", return_value=source):
+                self.assertIsNone(geography.load_compiled("wards", path=path))
+                geography.compile_geography("wards", path)
+                with mock.patch("builtins.open", wraps=open) as opened:
+                    self.assertIsNotNone(geography.load_compiled("wards", path=path))
+                self.assertNotIn(source, [args[0] for args, _ in opened.call_args_list])
+
+                os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+                self.assertIsNone(geography.load_compiled("wards", path=path))
+                with open(source, "a") as gf:
+                    gf.write("\n")
+                os.utime(source, (stat.st_atime, stat.st_mtime))
+                self.assertIsNone(geography.load_compiled("wards", path=path))
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import time
+import unittest as ut
+from datetime import date, timedelta
+from unittest import mock
+
+from reporter import cache
+
+
+class AggregationCacheTest(ut.TestCase):
+    def setUp(self):
+        self.now = time.time()
+
+    def checkBackend(self, backend):
+        backend.set("historical", [1, 2, 3])
+        backend.set("current", {"a": 1}, ttl=60)
+        self.assertEqual(backend.get("historical"), [1, 2, 3])
+        self.assertEqual(backend.get("current"), {"a": 1})
+        self.assertIsNone(backend.get("missing"))
+        with mock.patch("time.time", return_value=self.now + 61):
+            self.assertIsNone(backend.get("current"))
+            self.assertEqual(backend.get("historical"), [1, 2, 3])
+
+    def testMemoryCache(self):
+        self.checkBackend(cache.MemoryCache())
+
+    def testMemoryCacheEvictsOldest(self):
+        backend = cache.MemoryCache(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual((backend.get("a"), backend.get("c")), (1, 3))
+
+    def testSQLiteCache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.checkBackend(cache.SQLiteCache(os.path.join(tmp, "cache.db")))
+
+    def testSQLiteCacheShared(self):
+        """A second backend on the same file reuses its table and entries"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            cache.SQLiteCache(path).set("historical", [1, 2, 3])
+            self.assertEqual(cache.SQLiteCache(path).get("historical"), [1, 2, 3])
+
+    def testSQLiteCacheUnavailable(self):
+        backend = cache.SQLiteCache("/nonexistent/cache.db")
+        backend.set("historical", [1, 2, 3])
+        self.assertIsNone(backend.get("historical"))
+
+    def testKeyNormalized(self):
+        split_param, cache_key = cache.split_param, cache.cache_key
+        start, end = date(2019, 1, 1), date(2019, 12, 31)
+        self.assertEqual(
+            cache_key("counts", start, end, categories=split_param("b,a,b")),
+            cache_key("counts", start, end, categories=split_param("a,b")),
+        )
+        self.assertIsNone(split_param(""))
+
+    def testTTL(self):
+        self.assertIsNone(cache.cache_ttl(date.today() - timedelta(days=1)))
+        self.assertIsNotNone(cache.cache_ttl(date.today()))
+
+    def testCached(self):
+        compute = mock.Mock(return_value=[4, 5])
+        end = date.today() - timedelta(days=1)
+        with mock.patch.object(cache, "_cache", cache.MemoryCache()):
+            for _ in range(2):
+                result = cache.cached("counts", end, end, compute, geog="wards")
+                self.assertEqual(result, [4, 5])
+        compute.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,35 @@
+import unittest as ut
+from unittest import mock
+
+from reporter import categories
+from reporter.models import Categories
+from tests import requires_db
+
+
+class CategoryIndexTest(ut.TestCase):
+    def tearDown(self):
+        categories.session.remove()
+
+    def testColumns(self):
+        index = categories.CategoryIndex([(7, "Heat"), (2, "Repairs")])
+        self.assertEqual(index.names, ["Repairs", "Heat"])
+        self.assertEqual(index.columns([7, 2, 3, -1, 99]).tolist(), [1, 0, -1, -1, -1])
+        self.assertTrue(index.knows([2, 7]))
+        self.assertFalse(index.knows([2, 3]))
+        self.assertEqual(
+            index.region_dicts([[0, 3], [2, 1], [0, 0]]),
+            [{"Heat": 3}, {"Repairs": 2, "Heat": 1}, {}],
+        )
+
+    @requires_db
+    def testReloadsUnknownIds(self):
+        rows = categories.session.query(Categories.id, Categories.name).all()
+        stale = categories.CategoryIndex(rows[1:])
+        with mock.patch.object(categories, "_index", stale):
+            self.assertIs(categories.get_category_index(), stale)
+            index = categories.get_category_index([rows[0].id])
+        self.assertEqual(sorted(index.names), sorted(name for _, name in rows))
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,231 @@
+import csv
+import importlib
+import os
+import unittest as ut
+from datetime import date, datetime
+from io import StringIO
+from itertools import permutations
+from unittest import mock
+
+from sqlalchemy import event, func
+
+from reporter import app
+from reporter.database import db_session, engine
+from reporter.export import CSV_COLS
+from reporter.geography import get_geography
+from reporter.models import Calls, Categories, EvictionRecords, Issues, User
+from tests import requires_db
+
+# reporter.views is shadowed by the blueprint of the same name
+views = importlib.import_module("reporter.views")
+
+
+@requires_db
+class EvictionExportTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        admin = db_session.query(User).filter(User.role == "admin").first()
+        cls.record_count = (
+            db_session.query(EvictionRecords)
+            .filter(EvictionRecords.created_at >= "2000-01-01")
+            .count()
+        )
+        db_session.remove()
+        if admin is None:
+            raise ut.SkipTest("No admin user in the test database")
+
+        cls.admin_id = admin.id
+        cls.statements = statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        cls.count_statement = count_statement
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+    @classmethod
+    def tearDownClass(cls):
+        event.remove(engine, "before_cursor_execute", cls.count_statement)
+
+    def testStatementCount(self):
+        """The export loads the user and then selects every row in one query"""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["_user_id"] = str(self.admin_id)
+            sess["_fresh"] = True
+
+        del self.statements[:]
+        response = client.get("/eviction-record-csv?start_date=2000-01-01")
+        rows = list(csv.reader(StringIO(response.get_data(as_text=True))))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(rows) - 1, self.record_count)
+        self.assertLessEqual(len(self.statements), 2)
+
+    def testRecordWithoutCall(self):
+        """Records without calls have empty call columns besides call_issue"""
+        # Seed data may set ids itself, so the sequence isn't relied on
+        last_id = db_session.query(func.max(EvictionRecords.id)).scalar() or 0
+        record = EvictionRecords(id=last_id + 1, created_at=datetime(2001, 1, 1, 12))
+        db_session.add(record)
+        db_session.commit()
+        try:
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess["_user_id"] = str(self.admin_id)
+                sess["_fresh"] = True
+            response = client.get(
+                "/eviction-record-csv?start_date=2001-01-01&end_date=2001-01-02"
+            )
+            rows = list(csv.DictReader(StringIO(response.get_data(as_text=True))))
+        finally:
+            db_session.delete(record)
+            db_session.commit()
+            db_session.remove()
+
+        self.assertEqual([row["id"] for row in rows], [str(record.id)])
+        calls = {col: val for col, val in rows[0].items() if col.startswith("call_")}
+        self.assertEqual(calls.pop("call_call_issue"), "call")
+        self.assertEqual(set(calls.values()), {""})
+
+
+@requires_db
+class DetailExportTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        user = db_session.query(User).first()
+        db_session.remove()
+        if user is None:
+            raise ut.SkipTest("No user in the test database")
+        cls.user_id = user.id
+
+    def get(self, query):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["_user_id"] = str(self.user_id)
+            sess["_fresh"] = True
+        return client.get("/detail-csv?start_date=2000-01-01" + query)
+
+    def testRows(self):
+        """Calls and issues are streamed as CSV_COLS rows merged by created_at"""
+        # Issues without a title are labelled "call", and category names may
+        # contain the separator they're joined with
+        untitled_id, title = (
+            db_session.query(Issues.id, Issues.title).order_by(Issues.id).first()
+        )
+        untitled = Issues.id == untitled_id
+        category_id, name = (
+            db_session.query(Categories.id, Categories.name)
+            .order_by(Categories.id)
+            .first()
+        )
+        renamed = Categories.id == category_id
+        db_session.query(Issues).filter(untitled).update({"title": None})
+        db_session.query(Categories).filter(renamed).update({"name": name + ", misc"})
+        db_session.commit()
+        try:
+            response = self.get("")
+            self.assertTrue(response.is_streamed)
+            rows = list(csv.reader(StringIO(response.get_data(as_text=True))))
+            self.checkRows(response, rows, untitled_id)
+        finally:
+            db_session.query(Issues).filter(untitled).update({"title": title})
+            db_session.query(Categories).filter(renamed).update({"name": name})
+            db_session.commit()
+            db_session.remove()
+
+    def checkRows(self, response, rows, untitled_id):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertEqual(
+            response.headers["Content-Disposition"],
+            "attachment; filename=sa_export_detail_2000-01-01_{}.csv".format(
+                date.today().strftime("%Y-%m-%d")
+            ),
+        )
+        self.assertEqual(rows[0], CSV_COLS)
+        records = [dict(zip(CSV_COLS, row)) for row in rows[1:]]
+        created = [record["created_at"] for record in records]
+        self.assertEqual(created, sorted(created))
+
+        def text(value):
+            return "" if value is None else str(value)
+
+        def key(record):
+            return record["call_issue"], record["id"], record["created_at"]
+
+        by_key = {key(record): record for record in records}
+        self.assertEqual(len(by_key), len(records))
+        expected_keys = set()
+        for cls in (Calls, Issues):
+            objs = (
+                db_session.query(cls)
+                .filter(
+                    cls.created_at >= date(2000, 1, 1), cls.created_at <= date.today()
+                )
+                .order_by(cls.id)
+                .all()
+            )
+            for obj in objs:
+                label = "issue" if getattr(obj, "title", None) else "call"
+                expected_keys.add((label, str(obj.id), text(obj.created_at)))
+            untitled = [obj for obj in objs if obj.id == untitled_id]
+            for obj in objs[::25] + (untitled if cls is Issues else []):
+                label = "issue" if getattr(obj, "title", None) else "call"
+                record = by_key[label, str(obj.id), text(obj.created_at)]
+                names = [category.name for category in obj.categories]
+                with self.subTest(table=cls.__tablename__, id=obj.id):
+                    self.assertEqual(
+                        record["zip"], text(obj.address and obj.address.zip)
+                    )
+                    self.assertEqual(
+                        record["tenant_first_name"],
+                        text(obj.tenant and obj.tenant.first_name),
+                    )
+                    # Names are joined in no particular order
+                    self.assertIn(
+                        record["categories"],
+                        {", ".join(order) for order in permutations(names)},
+                    )
+        self.assertEqual(set(by_key), expected_keys)
+
+    def testWards(self):
+        """include_wards fills the ward column with the ward of each row's point"""
+        rows = list(csv.reader(StringIO(self.get("&include_wards=1").get_data(True))))
+        records = [dict(zip(CSV_COLS, row)) for row in rows[1:]]
+        wards = get_geography("wards")
+        regions = wards.assign(
+            [float(record["lon"] or "nan") for record in records],
+            [float(record["lat"] or "nan") for record in records],
+        )
+        self.assertEqual(
+            [record["ward"] for record in records],
+            [str(wards.regions[idx]) if idx >= 0 else "" for idx in regions.tolist()],
+        )
+        self.assertTrue(any(record["ward"] for record in records))
+
+    def testBatchSize(self):
+        """Batches only grow to the parallel size when wards are assigned in it"""
+        cases = [
+            ("", 2, False, 1000),
+            ("&include_wards=1", 1, False, 1000),
+            ("&include_wards=1", 2, True, 1000),
+            ("&include_wards=1", 2, False, 5000),
+        ]
+        env = {"ASSIGN_PARALLEL_ROWS": "5000"}
+        for query, workers, stored, expected in cases:
+            with self.subTest(query=query, workers=workers, stored=stored):
+                with mock.patch.dict(os.environ, env), mock.patch.object(
+                    views, "assign_workers", return_value=workers
+                ), mock.patch.object(
+                    views, "address_regions_available", return_value=stored
+                ), mock.patch.object(
+                    views, "iter_batches", return_value=iter([])
+                ) as iter_batches:
+                    self.get(query).get_data()
+                sizes = {call[0][1] for call in iter_batches.call_args_list}
+                self.assertEqual(sizes, {expected})
+
+
+if __name__ == "__main__":
+    ut.main()
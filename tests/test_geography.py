@@ -0,0 +1,235 @@
+import os
+import threading
+import unittest as ut
+from unittest import mock
+
+import numpy as np
+from shapely import vectorized
+from shapely.geometry import MultiPolygon, Polygon, box
+from shapely.prepared import prep
+
+from reporter import app, geography
+
+
+class ExitWhenUnpickled:
+    """Kills the worker process a task containing it is sent to"""
+
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+class RegionIndexTest(ut.TestCase):
+    def testIncompleteBackend(self):
+        class AssignOnly(geography.RegionIndex):
+            def assign(self, xs, ys):
+                return np.full(len(xs), -1)
+
+        with self.assertRaises(TypeError):
+            AssignOnly([])
+
+    def testNoPoints(self):
+        """Empty input, missing coordinates and points outside every region"""
+        nan = float("nan")
+        cases = [([], []), ([nan, nan], [nan, 41.9]), ([0.0, -87.6], [0.0, nan])]
+        for index in geography.REGION_INDEXES:
+            wards = geography.load_geography("wards", index)
+            for lons, lats in cases:
+                with self.subTest(index=index, lons=lons):
+                    regions = wards.assign(lons, lats)
+                    self.assertEqual(regions.tolist(), [-1] * len(lons))
+
+
+class ShapelyContainsTest(ut.TestCase):
+    """Regions are assigned the way testing every boundary with shapely would"""
+
+    def points(self, shapes):
+        """Return random points, and points on and next to boundary vertices and edges
+
+        Only every few vertices of long boundaries are used.
+        """
+        rng = np.random.RandomState(0)
+        minx, miny = np.min([shp.bounds[:2] for shp in shapes], axis=0)
+        maxx, maxy = np.max([shp.bounds[2:] for shp in shapes], axis=0)
+        points = [
+            np.column_stack(
+                [rng.uniform(minx, maxx, 5000), rng.uniform(miny, maxy, 5000)]
+            )
+        ]
+        for shp in shapes:
+            for polygon in getattr(shp, "geoms", [shp]):
+                coords = np.asarray(polygon.exterior.coords)
+                coords = coords[:: max(1, len(coords) // 100)]
+                for base in [coords, (coords[:-1] + coords[1:]) / 2]:
+                    points.append(base)
+                    points.append(base + rng.uniform(-1e-6, 1e-6, base.shape))
+        points = np.concatenate(points)
+        return points[:, 0], points[:, 1]
+
+    def testAssign(self):
+        for geog in geography.GEOGRAPHIES:
+            for index in geography.REGION_INDEXES:
+                with self.subTest(geog=geog, index=index):
+                    loaded = geography.load_geography(geog, index)
+                    xs, ys = self.points(loaded.shapes)
+                    inside = np.array(
+                        [
+                            vectorized.contains(prep(shp), xs, ys)
+                            for shp in loaded.shapes
+                        ]
+                    )
+                    regions = loaded.index.assign(xs, ys)
+                    found = regions >= 0
+                    self.assertEqual(
+                        np.flatnonzero(found != inside.any(axis=0)).tolist(), []
+                    )
+                    self.assertTrue(inside[regions[found], np.flatnonzero(found)].all())
+
+    def testCells(self):
+        """INTERIOR cells lie inside their region and EXTERIOR cells outside it"""
+        for geog in geography.GEOGRAPHIES:
+            loaded = geography.load_geography(geog)
+            for region, shp in list(zip(loaded.prepared, loaded.shapes))[::10]:
+                prepared = prep(shp)
+                (minx, miny), (width, height) = region.origin, region.cell_size
+                for ix, iy in zip(*np.nonzero(region.cells != geography.BOUNDARY)):
+                    cell = box(
+                        minx + ix * width,
+                        miny + iy * height,
+                        minx + (ix + 1) * width,
+                        miny + (iy + 1) * height,
+                    )
+                    if region.cells[ix, iy] == geography.INTERIOR:
+                        self.assertTrue(prepared.contains(cell), (ix, iy))
+                    else:
+                        self.assertFalse(prepared.intersects(cell), (ix, iy))
+
+    def testMultiPolygon(self):
+        """Regions made of several polygons, some with holes, are classified too"""
+        square = [(0, 0), (0, 4), (4, 4), (4, 0)]
+        shp = MultiPolygon(
+            [Polygon(square, [[(1, 1), (1, 3), (3, 3), (3, 1)]]), box(6, 1, 8, 5)]
+        )
+        region = geography.PreparedRegion(shp, cells_per_side=16)
+        rng = np.random.RandomState(0)
+        xs, ys = rng.uniform(0, 8, 5000), rng.uniform(0, 5, 5000)
+        self.assertEqual(
+            region.contains_many(xs, ys).tolist(),
+            vectorized.contains(shp, xs, ys).tolist(),
+        )
+        states = {geography.EXTERIOR, geography.INTERIOR, geography.BOUNDARY}
+        self.assertEqual(set(region.cells.ravel().tolist()), states)
+
+
+class DedupTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        lons = rng.uniform(-87.95, -87.5, 500)
+        lats = rng.uniform(41.6, 42.05, 500)
+        lons[:5] = np.nan
+        pick = rng.randint(0, 500, 5000)
+        cls.lons, cls.lats = lons[pick], lats[pick]
+
+    def testRepeatedPoints(self):
+        """Repeated points get the region each of them is in"""
+        for index in geography.REGION_INDEXES:
+            with self.subTest(index=index):
+                wards = geography.load_geography("wards", index)
+                before = geography.dedup_stats()
+                regions = wards.assign(self.lons, self.lats)
+                after = geography.dedup_stats()
+                expected = [
+                    -1 if idx is None else idx
+                    for idx in map(wards.locate, self.lons, self.lats)
+                ]
+                self.assertEqual(regions.tolist(), expected)
+                points = after["points"] - before["points"]
+                self.assertLess(after["unique"] - before["unique"], points)
+                self.assertGreater(after["hit_rate"], 0)
+
+    def testLoggedPerRequest(self):
+        wards = geography.get_geography("wards")
+        with self.assertLogs(geography.logger, "INFO") as logs:
+            with app.test_request_context():
+                app.preprocess_request()
+                wards.assign(self.lons, self.lats)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("hit rate", logs.output[0])
+
+
+class ParallelAssignTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wards = geography.get_geography("wards")
+        rng = np.random.RandomState(0)
+        cls.lons = rng.uniform(-87.95, -87.5, 2000)
+        cls.lats = rng.uniform(41.6, 42.05, 2000)
+        cls.lons[:5] = np.nan
+
+    def assign(self, workers):
+        env = {"ASSIGN_WORKERS": str(workers), "ASSIGN_PARALLEL_ROWS": "1000"}
+        with mock.patch.dict(os.environ, env):
+            return self.wards.assign(self.lons, self.lats).tolist()
+
+    def testMatchesSerial(self):
+        expected = self.wards.index.assign(self.lons, self.lats).tolist()
+        with mock.patch.object(geography, "_pool", None):
+            self.assertEqual(self.assign(2), expected)
+            pool = geography._pool
+        pool.terminate()
+        self.assertIsNotNone(pool)
+
+    def testLockHeldByThread(self):
+        """Workers don't start with locks held by other threads of this process"""
+        expected = self.wards.index.assign(self.lons, self.lats).tolist()
+        with mock.patch.object(geography, "_pool", None):
+            with geography._dedup_lock:
+                thread = threading.Thread(
+                    target=geography._get_pool, args=(2,), daemon=True
+                )
+                thread.start()
+                thread.join(60)
+            pool = geography._pool
+            self.assertEqual(self.assign(2), expected)
+            self.assertIs(geography._pool, pool)
+        pool.terminate()
+
+    def testFallsBack(self):
+        expected = self.wards.index.assign(self.lons, self.lats).tolist()
+        with mock.patch.object(geography, "_pool", None), mock.patch.object(
+            geography, "_new_pool", side_effect=OSError
+        ) as new_pool:
+            self.assertEqual(self.assign(2), expected)
+            self.assertEqual(self.assign(2), expected)
+            self.assertIs(geography._pool, False)
+        new_pool.assert_called_once_with(2)
+
+    def testWorkerKilled(self):
+        """A worker dying mid-batch shuts the pool down instead of hanging"""
+        expected = self.wards.index.assign(self.lons, self.lats).tolist()
+        points = np.array([ExitWhenUnpickled()] * 2, dtype=object)
+        env = {"ASSIGN_WORKERS": "2", "ASSIGN_TIMEOUT": "5"}
+        with mock.patch.object(geography, "_pool", None), mock.patch.dict(
+            os.environ, env
+        ):
+            self.assertIsNone(geography.assign_parallel("wards", points, points))
+            self.assertIs(geography._pool, False)
+            self.assertEqual(self.assign(2), expected)
+
+    def testDedupStats(self):
+        """Points deduplicated in the workers are counted by this process"""
+        before = geography.dedup_stats()
+        self.wards.index.assign(self.lons, self.lats)
+        serial = geography.dedup_stats()["points"] - before["points"]
+        with mock.patch.object(geography, "_pool", None):
+            before = geography.dedup_stats()
+            self.assign(2)
+            after = geography.dedup_stats()
+            pool = geography._pool
+        pool.terminate()
+        self.assertGreater(serial, 0)
+        self.assertEqual(after["points"] - before["points"], serial)
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,89 @@
+import os
+import unittest as ut
+from unittest import mock
+
+from psycopg2 import errors
+from sqlalchemy.exc import DBAPIError
+
+from reporter import aggregation, app, cache, postgis
+from reporter.geography import get_geography
+from reporter.utils import handle_dates, point_counts, union_points
+from tests import requires_db
+
+
+class RegionsLoadedTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wards = get_geography("wards")
+
+    def setUp(self):
+        postgis._loaded.clear()
+        postgis._unavailable = False
+
+    def load(self, orig):
+        error = DBAPIError.instance("CREATE TABLE", {}, orig, errors.Error)
+        with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": "1"}), mock.patch.object(
+            postgis.engine, "begin", side_effect=error
+        ):
+            return postgis.regions_loaded(self.wards)
+
+    def testTransientErrors(self):
+        """Lost connections and concurrent loads are retried on the next call"""
+        for orig in [
+            errors.AdminShutdown("terminating connection"),
+            errors.UniqueViolation("duplicate key value"),
+        ]:
+            with self.subTest(orig=orig):
+                self.assertFalse(self.load(orig))
+                self.assertFalse(postgis._unavailable)
+
+    def testMissingPostgis(self):
+        self.assertFalse(self.load(errors.UndefinedObject("type does not exist")))
+        self.assertTrue(postgis._unavailable)
+        with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": "1"}):
+            self.assertFalse(postgis.regions_loaded(self.wards))
+
+
+@requires_db
+class PostgisRegionTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wards = get_geography("wards")
+        cls.dates = handle_dates("2000-01-01", None)
+        cls.tables = point_counts(*cls.dates, None, None)
+        cls.points = union_points(cls.tables)
+
+    def setUp(self):
+        postgis._loaded.clear()
+        postgis._unavailable = False
+
+    def tearDown(self):
+        postgis.session.remove()
+
+    def testDisabled(self):
+        with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": ""}):
+            self.assertIsNone(postgis.region_point_counts(self.wards, self.points))
+
+    def testCountsMatchInProcess(self):
+        with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": "1"}):
+            if not postgis.regions_loaded(self.wards):
+                self.skipTest("PostGIS is not installed in the test database")
+            counts = postgis.region_point_counts(self.wards, self.points)
+
+        with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": ""}):
+            expected = aggregation.count_records(self.wards, self.tables)
+        self.assertEqual(counts, expected)
+
+    def testFallsBack(self):
+        """Geo filter results are the same whether or not PostGIS is used"""
+        request = app.test_request_context(query_string={"geog": "wards"})
+        with mock.patch.object(cache, "_cache", False), request as ctx:
+            with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": ""}):
+                expected = aggregation.handle_geog_filter(ctx.request, *self.dates)
+            with mock.patch.dict(os.environ, {"POSTGIS_REGIONS": "1"}):
+                result = aggregation.handle_geog_filter(ctx.request, *self.dates)
+        self.assertEqual(result.to_dict(), expected.to_dict())
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,82 @@
+import os
+import unittest as ut
+from datetime import date, datetime
+from unittest import mock
+
+from sqlalchemy import func
+
+from reporter import aggregation, cache, rollup
+from reporter.models import Addresses, Calls, Categories
+from tests import requires_db
+
+
+@requires_db
+class DailyRollupTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rollup.run_rollup(full=True)
+        category = rollup.session.query(Categories.name).first()
+        cls.category = category.name if category else None
+        rollup.session.remove()
+
+    def tearDown(self):
+        rollup.session.remove()
+
+    def aggregate(self, *args, use_rollup=False):
+        env = {"DAILY_ROLLUP": "1" if use_rollup else ""}
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            cache, "_cache", False
+        ):
+            return aggregation.aggregate(*args).to_dict()
+
+    def testMatchesLiveCounts(self):
+        for dates in [(date(2000, 1, 1), date.today()), (date(2019, 3, 1),) * 2]:
+            for categories in [None, self.category]:
+                for geog in ["wards", "zips"]:
+                    args = (*dates, categories, None, geog)
+                    with self.subTest(args=args):
+                        self.assertEqual(
+                            self.aggregate(*args, use_rollup=True),
+                            self.aggregate(*args),
+                        )
+
+    def testSeveralCategories(self):
+        """Records in several categories would be counted repeatedly"""
+        wards = aggregation.get_geography("wards")
+        with mock.patch.dict(os.environ, {"DAILY_ROLLUP": "1"}):
+            counts = rollup.rollup_counts(wards, date(2000, 1, 1), None, "a,b")
+        self.assertIsNone(counts)
+
+    def testRecordAfterRun(self):
+        """Days after the last run's high-water mark are counted live"""
+        session = rollup.session
+        args = (date(2000, 1, 1), date.today(), None, None, "wards")
+        before = self.aggregate(*args)
+        address = session.query(Addresses).filter(Addresses.lat.isnot(None)).first()
+        last_id = session.query(func.max(Calls.id)).scalar() or 0
+        call = Calls(
+            id=last_id + 1,
+            created_at=datetime.combine(date.today(), datetime.min.time()),
+            address=address,
+        )
+        session.add(call)
+        session.commit()
+        try:
+            live = self.aggregate(*args)
+            counts = self.aggregate(*args, use_rollup=True)
+        finally:
+            session.delete(call)
+            session.commit()
+
+        self.assertEqual(
+            sum(live["totals"]) + live["unassigned"],
+            sum(before["totals"]) + before["unassigned"] + 1,
+        )
+        self.assertEqual(counts, live)
+
+    def testIncremental(self):
+        self.assertEqual(rollup.run_rollup(), 0)
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest as ut
+from datetime import date
+from unittest import mock
+
+from reporter import aggregation, cache, snapshot
+from reporter.models import Addresses, Categories
+from tests import requires_db
+
+
+@requires_db
+class SnapshotTest(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        snapshot.export_snapshot(cls.tmp.name)
+        session = snapshot.session
+        cls.category = session.query(Categories.name).limit(1).scalar()
+        cls.zip_code = session.query(Addresses.zip).limit(1).scalar()
+        session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def tearDown(self):
+        snapshot.session.remove()
+
+    def aggregate(self, *args, source="live"):
+        env = {"REPORT_SOURCE": source, "SNAPSHOT_DIR": self.tmp.name}
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            cache, "_cache", False
+        ), mock.patch.object(snapshot, "_snapshot", None):
+            return aggregation.aggregate(*args).to_dict()
+
+    def testMatchesLiveCounts(self):
+        for categories in [None, self.category, "{},missing".format(self.category)]:
+            for zip_codes in [None, self.zip_code]:
+                for geog in ["wards", "zips"]:
+                    args = (date(2000, 1, 1), date.today(), categories, zip_codes, geog)
+                    with self.subTest(args=args):
+                        self.assertEqual(
+                            self.aggregate(*args, source="snapshot"),
+                            self.aggregate(*args),
+                        )
+
+    def testMissingSnapshot(self):
+        env = {"REPORT_SOURCE": "snapshot", "SNAPSHOT_DIR": "/nonexistent"}
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            snapshot, "_snapshot", None
+        ):
+            self.assertIsNone(snapshot.get_snapshot())
+
+
+if __name__ == "__main__":
+    ut.main()
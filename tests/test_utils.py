@@ -0,0 +1,58 @@
+import threading
+import unittest as ut
+
+from reporter import utils
+from reporter.database import engine
+from tests import requires_db
+
+
+class ConcurrencyTest(ut.TestCase):
+    def tearDown(self):
+        utils.session.remove()
+
+    @requires_db
+    def testRunConcurrently(self):
+        """Each function gets a session of its own, removed once it returns"""
+        sessions = []
+
+        def query(value):
+            session = utils.session()
+            sessions.append(session)
+            return session.execute("SELECT {}".format(value)).scalar()
+
+        results = utils.run_concurrently(lambda: query(1), lambda: query(2))
+        self.assertEqual(results, [1, 2])
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertEqual(engine.pool.checkedout(), 0)
+
+    def testIterInThread(self):
+        self.assertEqual(list(utils.iter_in_thread(lambda: range(10))), list(range(10)))
+
+        def fail():
+            yield 1
+            raise ValueError("failed")
+
+        items = utils.iter_in_thread(fail)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def testIterInThreadClosed(self):
+        """Closing the generator early stops the producing thread"""
+        produced = []
+
+        def endless():
+            while True:
+                produced.append(None)
+                yield len(produced)
+
+        threads = threading.active_count()
+        items = utils.iter_in_thread(endless, maxsize=2)
+        self.assertEqual(next(items), 1)
+        items.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertLessEqual(len(produced), 4)
+
+
+if __name__ == "__main__":
+    ut.main()